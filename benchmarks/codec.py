@@ -0,0 +1,71 @@
+"""
+Micro-benchmark - encode and decode throughput of the stored message codecs
+
+    python3 -m benchmarks.codec --count 100000 --body-size 1024
+"""
+import json
+import time
+import random
+import string
+import argparse
+
+from eventreplay.eventers.sqs import SQSMessage
+from eventreplay.storage import codec
+
+CODECS = ('dict', 'json', 'binary')
+
+
+def messages(count, body_size):
+    """
+    SQS-like messages with a json body of roughly body_size bytes
+    """
+    text = ''.join(random.choices(string.ascii_letters, k=body_size))
+    return [
+        SQSMessage(
+            message_id=f'{i:08x}-9c1e-4f4e-8a4f-3f8d2b7c6e1a',
+            body=json.dumps({'tenant': f't{i % 50}', 'event': 'order.created', 'data': text}),
+            attributes={'SentTimestamp': str(1728999999000 + i)},
+            md5_of_body='0cc175b9c0f1b6a831c399e269772661',
+        )
+        for i in range(count)
+    ]
+
+
+def bench(name, records):
+    c = codec.get(name, SQSMessage.FIELDS)
+    started = time.perf_counter()
+    encoded = [c.encode(record) for record in records]
+    encode_time = time.perf_counter() - started
+    started = time.perf_counter()
+    for data in encoded:
+        SQSMessage.from_binary(data)
+    decode_time = time.perf_counter() - started
+    size = sum(len(data) for data in encoded)
+    return {
+        'codec': name,
+        'encode_per_sec': len(records) / encode_time,
+        'decode_per_sec': len(records) / decode_time,
+        'bytes_per_message': size / len(records),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='codec benchmark')
+    parser.add_argument('--count', type=int, default=50000)
+    parser.add_argument('--body-size', type=int, default=512)
+    parser.add_argument('--json', action='store_true', dest='as_json', help='print results as json')
+    args = parser.parse_args()
+
+    records = messages(args.count, args.body_size)
+    results = [bench(name, records) for name in CODECS]
+    if args.as_json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.count} messages, {args.body_size} byte bodies')
+    print(f'{"codec":<8} {"encode/s":>12} {"decode/s":>12} {"bytes/msg":>10}')
+    for r in results:
+        print(f'{r["codec"]:<8} {r["encode_per_sec"]:>12,.0f} {r["decode_per_sec"]:>12,.0f} {r["bytes_per_message"]:>10,.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+In-process stand-ins for the S3, SQS and Kinesis clients, with just enough of each
+API for the consumers, writer, reader and replayers. Every call can be delayed by
+`latency` seconds to stand in for the network.
+"""
+import time
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+
+def _error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'fake')
+
+
+class Body():
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class S3():
+    """
+    Objects in a dict. Supports ranged gets, listing and conditional puts.
+    `fetched` holds the perf_counter time each key was last read.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self.fetched = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Body, Bucket, Key, IfMatch=None, IfNoneMatch=None, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            current = self.objects.get((Bucket, Key))
+            if IfNoneMatch == '*' and current is not None:
+                raise _error('PreconditionFailed')
+            if IfMatch is not None and (current is None or self._etag(current) != IfMatch):
+                raise _error('PreconditionFailed')
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {'ETag': self._etag(Body)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        time.sleep(self.latency)
+        data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise _error('NoSuchKey')
+        etag = self._etag(data)
+        if Range:
+            first, _, last = Range[len('bytes='):].partition('-')
+            data = data[int(first):int(last) + 1]
+        self.fetched[Key] = time.perf_counter()
+        return {'Body': Body(data), 'ETag': etag, 'ContentLength': len(data)}
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix='', **kwargs):
+        time.sleep(self.latency)
+        keys = sorted(key for bucket, key in list(self.objects) if bucket == Bucket and key.startswith(Prefix))
+        yield {'Contents': [
+            {'Key': key, 'Size': len(self.objects[(Bucket, key)]), 'ETag': self._etag(self.objects[(Bucket, key)])}
+            for key in keys
+        ]}
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, **kwargs):
+        contents = next(self.paginate(Bucket, Prefix))['Contents'][:MaxKeys]
+        return {'Contents': contents, 'KeyCount': len(contents)}
+
+    @staticmethod
+    def _etag(data):
+        return f'"{hashlib.md5(bytes(data)).hexdigest()}"'
+
+
+class Message():
+    """
+    Received SQS message, as returned by the boto3 resource
+    """
+    def __init__(self, message_id, body, sent):
+        self.message_id = message_id
+        self.body = body
+        self.attributes = {'SentTimestamp': str(sent)}
+        self.message_attributes = None
+        self.md5_of_body = None
+        self.receipt_handle = f'handle-{message_id}'
+
+
+class SQSClient():
+    """
+    Low-level client behind a Queue. `sent` holds (perf_counter time, body) for
+    every message sent, receives come from the Queue's messages.
+    """
+    def __init__(self, latency=0.0, queue=None):
+        self.latency = latency
+        self.queue = queue
+        self.sent = []
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        messages = self.queue.receive_messages(MaxNumberOfMessages=MaxNumberOfMessages)
+        return {'Messages': [
+            {'MessageId': m.message_id, 'ReceiptHandle': m.receipt_handle, 'Body': m.body,
+             'Attributes': m.attributes, 'MD5OfBody': m.md5_of_body}
+            for m in messages
+        ]}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency)
+        now = time.perf_counter()
+        self.sent.extend((now, entry['MessageBody']) for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+class Meta():
+    def __init__(self, client):
+        self.client = client
+
+
+class Queue():
+    """
+    Queue resource holding `messages` to receive
+    """
+    url = 'https://sqs.fake/000000000000/benchmark'
+
+    def __init__(self, messages=(), latency=0.0):
+        self.messages = list(messages)
+        self.position = 0
+        self.latency = latency
+        self.meta = Meta(SQSClient(latency, self))
+        self.lock = threading.Lock()
+
+    def receive_messages(self, MaxNumberOfMessages=1, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            messages = self.messages[self.position:self.position + MaxNumberOfMessages]
+            self.position += len(messages)
+        return messages
+
+    def delete_messages(self, Entries):
+        time.sleep(self.latency)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+class SQS():
+    """
+    Stands in for boto3.resource('sqs')
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def get_queue_by_name(self, QueueName):
+        return self.queue
+
+
+class KinesisErrors():
+    class ProvisionedThroughputExceededException(Exception):
+        pass
+
+    class ExpiredIteratorException(Exception):
+        pass
+
+
+class Waiter():
+    def wait(self, **kwargs):
+        pass
+
+
+class Kinesis():
+    """
+    Stream of open shards, `shards` maps a shard id to its records as
+    (partition key, data, arrival epoch ms)
+    """
+    exceptions = KinesisErrors
+
+    def __init__(self, shards, latency=0.0):
+        self.latency = latency
+        self.shards = shards
+
+    def get_waiter(self, name):
+        return Waiter()
+
+    def list_shards(self, **kwargs):
+        time.sleep(self.latency)
+        return {'Shards': [
+            {'ShardId': shard_id, 'SequenceNumberRange': {'StartingSequenceNumber': '0'}}
+            for shard_id in self.shards
+        ]}
+
+    def get_shard_iterator(self, ShardId, ShardIteratorType, StartingSequenceNumber, **kwargs):
+        time.sleep(self.latency)
+        position = int(StartingSequenceNumber)
+        if ShardIteratorType == 'AFTER_SEQUENCE_NUMBER':
+            position += 1
+        return {'ShardIterator': f'{ShardId}:{position}'}
+
+    def get_records(self, ShardIterator, Limit):
+        time.sleep(self.latency)
+        shard_id, _, position = ShardIterator.rpartition(':')
+        position = int(position)
+        records = self.shards[shard_id][position:position + Limit]
+        end = position + len(records)
+        return {
+            'Records': [
+                {
+                    'SequenceNumber': str(position + ind),
+                    'PartitionKey': key,
+                    'Data': data,
+                    'ApproximateArrivalTimestamp': datetime.fromtimestamp(arrived / 1000, tz=timezone.utc),
+                }
+                for ind, (key, data, arrived) in enumerate(records)
+            ],
+            'NextShardIterator': f'{shard_id}:{end}',
+            'MillisBehindLatest': 1000 if end < len(self.shards[shard_id]) else 0,
+        }
+
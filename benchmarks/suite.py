@@ -0,0 +1,304 @@
+"""
+Offline benchmark - consume, persist and replay throughput against the in-process
+stand-ins in benchmarks.fakes, no AWS resources needed
+
+    python3 -m benchmarks.suite --count 20000 --sizes 256,4096 --batch-sizes 10,100
+    python3 -m benchmarks.suite --save-baseline baseline.json
+    python3 -m benchmarks.suite --baseline baseline.json --output results.json
+
+Stages:
+
+    sqs-consume      SQSConsumer.consume, persisting through the spool
+    kinesis-consume  KinesisConsumer.consume over 2 shards, persisting
+    persist          Writer.buffer and write, batch-size files per write
+    sqs-replay       SQSReplayer.replay of stored messages
+
+Per-message latency is the time the caller waited for a message for the consumers,
+buffer to written for persist, and object fetched to message sent for replay. The
+batch size is messages per receive, get_records call or write, replay sends fixed
+batches so runs once per message size. Each case runs in a fresh process so the peak
+RSS is its own.
+
+With `--baseline` results are compared to a stored run and the exit status is 1 when
+throughput drops, or p99 latency or peak RSS grows, by more than `--tolerance`.
+No baseline ships with the repo, the numbers depend on the machine, so save one
+on the machine that runs the comparison, eg before a change.
+"""
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks import fakes
+from eventreplay import clients
+
+BUCKET = 'benchmark'
+BASE_MS = 1728999960000 # 2024/10/15/13/46
+SPREAD_MS = 10 * 60 * 1000 # messages are spread over 10 minute partitions
+START, END = '2024/10/15/13/46', '2024/10/15/13/55'
+SHARDS = 2
+STORAGE = dict(segment=True, compression='gzip', manifest=True)
+SQS_MAX_BATCH = 10
+
+
+def _bodies(count, size):
+    pad = ''.join(random.choices(string.ascii_letters, k=size))
+    return [f'{{"seq":{i},"data":"{pad}"}}' for i in range(count)]
+
+
+def _seq(body):
+    return int(body[len('{"seq":'):body.index(',')])
+
+
+def _sent(i, count):
+    return BASE_MS + i * SPREAD_MS // count
+
+
+def sqs_consume(count, size, batch, latency):
+    from eventreplay.eventers import sqs
+    clients.inject('s3', fakes.S3(latency))
+    messages = [fakes.Message(f'{i:08x}', body, _sent(i, count)) for i, body in enumerate(_bodies(count, size))]
+    clients.inject('sqs', fakes.SQS(fakes.Queue(messages, latency)), kind='resource')
+    with tempfile.TemporaryDirectory() as tmp:
+        consumer = sqs.SQSConsumer('benchmark', storage_destination=BUCKET, storage_options=STORAGE,
+                                   spool_path=os.path.join(tmp, 'benchmark.spool'))
+        consumer.max_number_of_messages = batch
+        latencies = []
+        started = last = time.perf_counter()
+        received = consumer.consume()
+        for ind, _ in enumerate(received, 1):
+            now = time.perf_counter()
+            latencies.append(now - last)
+            last = now
+            if ind == count:
+                break
+        # uploads whatever is left in the spool
+        received.close()
+        return time.perf_counter() - started, latencies
+
+
+def kinesis_consume(count, size, batch, latency):
+    from eventreplay.eventers import kinesis
+    # measure the library rather than the 5 calls per second shard limit
+    kinesis.MIN_FETCH_INTERVAL = 0
+    clients.inject('s3', fakes.S3(latency))
+    shards = {f'shardId-{n:012}': [] for n in range(SHARDS)}
+    for i, body in enumerate(_bodies(count, size)):
+        shards[f'shardId-{i % SHARDS:012}'].append((f'key-{i % 100}', body.encode('utf-8'), _sent(i, count)))
+    clients.inject('kinesis', fakes.Kinesis(shards, latency))
+    with tempfile.TemporaryDirectory() as tmp:
+        consumer = kinesis.KinesisConsumer('benchmark', storage_destination=BUCKET, storage_options=STORAGE,
+                                           fetch_limit=batch, poll_interval=0.05,
+                                           spool_path=os.path.join(tmp, 'benchmark.spool'))
+        latencies = []
+        started = last = time.perf_counter()
+        received = consumer.consume()
+        for records in received:
+            now = time.perf_counter()
+            latencies.extend([now - last] * len(records))
+            last = now
+            if len(latencies) >= count:
+                break
+        # uploads whatever is left in the spool
+        received.close()
+        return time.perf_counter() - started, latencies[:count]
+
+
+def persist(count, size, batch, latency):
+    from eventreplay.eventers.sqs import SQSMessage
+    from eventreplay.storage import s3, codec
+    clients.inject('s3', fakes.S3(latency))
+    writer = s3.Writer.from_sqs(BUCKET, codec=codec.get('json', SQSMessage.FIELDS), **STORAGE)
+    files = []
+    for i, body in enumerate(_bodies(count, size)):
+        sent = _sent(i, count)
+        message = SQSMessage.from_boto3(fakes.Message(f'{i:08x}', body, sent))
+        ts = time.strftime('%Y/%m/%d/%H/%M', time.gmtime(sent / 1000))
+        files.append(s3.File(message.message_id, ts, message, sent))
+    latencies = []
+    started = time.perf_counter()
+    for first in range(0, count, batch):
+        buffered = []
+        for file in files[first:first + batch]:
+            buffered.append(time.perf_counter())
+            writer.buffer(file)
+        writer.write()
+        done = time.perf_counter()
+        latencies.extend(done - ts for ts in buffered)
+    writer.flush()
+    return time.perf_counter() - started, latencies
+
+
+def sqs_replay(count, size, batch, latency):
+    from eventreplay.eventers import sqs
+    from eventreplay.storage import s3, codec
+    store = fakes.S3()
+    clients.inject('s3', store)
+    writer = s3.Writer.from_sqs(BUCKET, codec=codec.get('json', sqs.SQSMessage.FIELDS), **STORAGE)
+    for i, body in enumerate(_bodies(count, size)):
+        sent = _sent(i, count)
+        ts = time.strftime('%Y/%m/%d/%H/%M', time.gmtime(sent / 1000))
+        writer.buffer(s3.File(f'{i:08x}', ts, sqs.SQSMessage.from_boto3(fakes.Message(f'{i:08x}', body, sent)), sent))
+    writer.flush()
+    objects = {}
+    for (_, key), data in store.objects.items():
+        if s3.is_segment(key):
+            for message in s3.split_segment(key, data):
+                objects[_seq(sqs.SQSMessage.from_binary(message).body)] = key
+    store.latency = latency
+    queue = fakes.Queue(latency=latency)
+    clients.inject('sqs', fakes.SQS(queue), kind='resource')
+    replayer = sqs.SQSReplayer(queue='benchmark')
+    started = time.perf_counter()
+    replayer.replay(START, END, BUCKET)
+    elapsed = time.perf_counter() - started
+    latencies = [sent - store.fetched[objects[_seq(body)]] for sent, body in queue.meta.client.sent]
+    return elapsed, latencies
+
+
+# stage -> (function, largest batch size, 0 when batch size doesn't apply)
+STAGES = {
+    'sqs-consume': (sqs_consume, SQS_MAX_BATCH),
+    'kinesis-consume': (kinesis_consume, 10000),
+    'persist': (persist, None),
+    'sqs-replay': (sqs_replay, 0),
+}
+
+
+def _percentile(ordered, q):
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_case(stage, count, size, batch, latency):
+    fn, _ = STAGES[stage]
+    elapsed, latencies = fn(count, size, batch, latency)
+    ordered = sorted(latencies)
+    return {
+        'stage': stage,
+        'size': size,
+        'batch': batch,
+        'count': count,
+        'elapsed': elapsed,
+        'messages_per_sec': count / elapsed,
+        'p50_ms': _percentile(ordered, 0.5) * 1000,
+        'p99_ms': _percentile(ordered, 0.99) * 1000,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def cases(stages, sizes, batch_sizes):
+    for stage, size in itertools.product(stages, sizes):
+        _, largest = STAGES[stage]
+        if largest == 0:
+            yield stage, size, None
+            continue
+        for batch in batch_sizes:
+            if largest is None or batch <= largest:
+                yield stage, size, batch
+
+
+def _key(result):
+    return result['stage'], result['size'], result['batch']
+
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions against a baseline run, as (result, metric, baseline value) tuples
+    """
+    previous = {_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+        if result['messages_per_sec'] < old['messages_per_sec'] * (1 - tolerance):
+            regressions.append((result, 'messages_per_sec', old['messages_per_sec']))
+        for metric in ('p99_ms', 'peak_rss_mb'):
+            if result[metric] > old[metric] * (1 + tolerance):
+                regressions.append((result, metric, old[metric]))
+    return regressions
+
+
+def _csv(value, kind):
+    return [kind(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline consume, persist and replay benchmark')
+    parser.add_argument('--count', type=int, default=20000, help='messages per case')
+    parser.add_argument('--sizes', type=lambda v: _csv(v, int), default=[256, 4096], help='message body bytes')
+    parser.add_argument('--batch-sizes', type=lambda v: _csv(v, int), default=[10, 100])
+    parser.add_argument('--stages', type=lambda v: _csv(v, str), default=list(STAGES))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake client call')
+    parser.add_argument('--output', help='write results as json')
+    parser.add_argument('--baseline', help='compare against results saved with --save-baseline')
+    parser.add_argument('--save-baseline', help='save results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed change against the baseline')
+    args = parser.parse_args()
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(sorted(unknown))}')
+    if args.baseline and not os.path.exists(args.baseline):
+        parser.error(f'no baseline at {args.baseline}, save one with --save-baseline first')
+
+    # read by eventreplay on import in each case process
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    results = []
+    print(f'{"stage":<16} {"size":>6} {"batch":>6} {"msg/s":>10} {"p50 ms":>9} {"p99 ms":>9} {"rss MB":>8}')
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1) as pool:
+        for stage, size, batch in cases(args.stages, args.sizes, args.batch_sizes):
+            r = pool.submit(run_case, stage, args.count, size, batch, args.latency).result()
+            results.append(r)
+            print(f'{r["stage"]:<16} {r["size"]:>6} {str(r["batch"] or "-"):>6} {r["messages_per_sec"]:>10,.0f} '
+                  f'{r["p50_ms"]:>9.3f} {r["p99_ms"]:>9.3f} {r["peak_rss_mb"]:>8.1f}')
+
+    document = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'count': args.count,
+            'latency': args.latency,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'results': results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(document, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        for setting in ('count', 'latency'):
+            if baseline['meta'].get(setting) != document['meta'][setting]:
+                print(f'warning: baseline ran with {setting}={baseline["meta"].get(setting)}, '
+                      f'this run with {setting}={document["meta"][setting]}')
+        regressions = compare(results, baseline, args.tolerance)
+        for result, metric, old in regressions:
+            print(f'REGRESSION {result["stage"]} size={result["size"]} batch={result["batch"]}: '
+                  f'{metric} {result[metric]:,.3f} vs baseline {old:,.3f}')
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
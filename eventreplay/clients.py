@@ -0,0 +1,142 @@
+"""
+Shared AWS clients and resources, built on first use.
+
+Clients are cached per (service, region, config), so every consumer, writer and
+reader in a process shares one connection pool per service. Defaults are set
+with `configure`, eg before starting many replay threads:
+
+    clients.configure(region='eu-west-1', max_pool_connections=64, retry_mode='adaptive')
+
+`inject` replaces a service with a stand-in, eg the fakes in benchmarks.fakes.
+
+`aio_client` opens an asyncio client on aiobotocore, an optional dependency only
+the aio eventers need. These are not shared, each belongs to the loop it was
+opened in.
+"""
+import os
+import threading
+import contextlib
+
+from eventreplay import exceptions
+
+
+MAX_POOL_CONNECTIONS = 50 # botocore defaults to 10, below the default reader and sender pools
+RETRY_MODE = 'standard'
+DEFAULT_REGION = 'us-west-2'
+
+SETTINGS = ('region', 'max_pool_connections', 'retry_mode', 'max_attempts', 'connect_timeout', 'read_timeout')
+
+_settings = {
+    'region': os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or DEFAULT_REGION,
+    'max_pool_connections': MAX_POOL_CONNECTIONS,
+    'retry_mode': RETRY_MODE,
+    'max_attempts': None,
+    'connect_timeout': None,
+    'read_timeout': None,
+}
+_cache = {}
+_injected = {}
+_lock = threading.Lock()
+
+
+def _check(settings):
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise exceptions.EventerException(f'unknown client settings: {", ".join(sorted(unknown))}')
+
+
+def configure(**settings):
+    """
+    Change the defaults for clients built from now on. Clients already built are
+    dropped from the cache, objects holding one keep using it.
+    """
+    _check(settings)
+    with _lock:
+        _settings.update(settings)
+        _cache.clear()
+
+
+def inject(service, stand_in, kind='client'):
+    """
+    Use `stand_in` for a service's client or resource, None restores the real one
+    """
+    with _lock:
+        if stand_in is None:
+            _injected.pop((kind, service), None)
+        else:
+            _injected[(kind, service)] = stand_in
+
+
+def client(service, **settings):
+    """
+    Shared boto3 client, `settings` override the configured defaults
+    """
+    return _get('client', service, settings)
+
+
+def resource(service, **settings):
+    """
+    Shared boto3 resource, `settings` override the configured defaults
+    """
+    return _get('resource', service, settings)
+
+
+@contextlib.asynccontextmanager
+async def aio_client(service, **settings):
+    """
+    Asyncio client, closed on leaving the block, `settings` override the configured defaults
+
+        async with clients.aio_client('sqs') as sqs:
+            response = await sqs.receive_message(QueueUrl=url)
+
+    Stand-ins are injected with kind='aio'.
+    """
+    _check(settings)
+    stand_in = _injected.get(('aio', service))
+    if stand_in is not None:
+        yield stand_in
+        return
+    try:
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import get_session
+    except ImportError:
+        raise exceptions.EventerException('asyncio clients need aiobotocore: pip install aiobotocore') from None
+    settings = dict(_settings, **settings)
+    session = get_session()
+    async with session.create_client(service, region_name=settings['region'], config=AioConfig(**_config(settings))) as built:
+        yield built
+
+
+def _get(kind, service, settings):
+    _check(settings)
+    stand_in = _injected.get((kind, service))
+    if stand_in is not None:
+        return stand_in
+    with _lock:
+        settings = dict(_settings, **settings)
+        key = (kind, service, tuple(sorted(settings.items())))
+        built = _cache.get(key)
+        if built is None:
+            built = _cache[key] = _build(kind, service, settings)
+        return built
+
+
+def _config(settings):
+    """
+    botocore Config arguments for `settings`
+    """
+    retries = {'mode': settings['retry_mode']}
+    if settings['max_attempts'] is not None:
+        retries['max_attempts'] = settings['max_attempts']
+    timeouts = {name: settings[name] for name in ('connect_timeout', 'read_timeout') if settings[name] is not None}
+    return dict(max_pool_connections=settings['max_pool_connections'], retries=retries, **timeouts)
+
+
+def _build(kind, service, settings):
+    # imported here, boto3 alone takes a noticeable share of a cold start
+    import boto3
+    from botocore.config import Config
+
+    config = Config(**_config(settings))
+    build = boto3.client if kind == 'client' else boto3.resource
+    return build(service, region_name=settings['region'], config=config)
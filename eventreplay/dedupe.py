@@ -0,0 +1,75 @@
+"""
+Remember recently seen message ids to drop duplicate deliveries.
+"""
+import time
+from collections import OrderedDict
+
+from eventreplay import exceptions
+from eventreplay.storage.filters import Bloom
+
+
+DEDUPE_CAPACITY = 100000 # ids remembered
+DEDUPE_WINDOW = 600 # seconds, for the bloom filter
+DEDUPE_ERROR_RATE = 0.0001 # chance a new id is taken for a duplicate, for the bloom filter
+
+
+class Recent():
+    """
+    The last `capacity` ids seen, exact. Ids are kept as their hash, so memory
+    doesn't grow with id length.
+    """
+    def __init__(self, capacity=DEDUPE_CAPACITY):
+        self.capacity = capacity
+        self.ids = OrderedDict()
+
+    def seen(self, message_id):
+        """
+        True when the id was seen before, otherwise it's remembered
+        """
+        key = hash(message_id)
+        if key in self.ids:
+            self.ids.move_to_end(key)
+            return True
+        self.ids[key] = None
+        if len(self.ids) > self.capacity:
+            self.ids.popitem(last=False)
+        return False
+
+
+class Windowed():
+    """
+    Ids seen in the last one to two `window`s, in two bloom filters that are
+    swapped every window. Uses a fraction of the memory of `Recent`, but a new id
+    is taken for a duplicate with probability DEDUPE_ERROR_RATE.
+    """
+    def __init__(self, capacity=DEDUPE_CAPACITY, window=DEDUPE_WINDOW):
+        self.capacity = capacity
+        self.window = window
+        self.current = Bloom(capacity, error_rate=DEDUPE_ERROR_RATE)
+        self.previous = Bloom(capacity, error_rate=DEDUPE_ERROR_RATE)
+        self.rotated = time.monotonic()
+
+    def seen(self, message_id):
+        now = time.monotonic()
+        if now - self.rotated >= self.window:
+            self.previous, self.current = self.current, Bloom(self.capacity, error_rate=DEDUPE_ERROR_RATE)
+            self.rotated = now
+        if message_id in self.current or message_id in self.previous:
+            return True
+        self.current.add(message_id)
+        return False
+
+
+def get(kind, capacity=DEDUPE_CAPACITY, window=DEDUPE_WINDOW):
+    """
+    Build a seen-set by name, None turns dedupe off
+    """
+    match kind:
+        case None | False:
+            return None
+        case True | 'lru':
+            return Recent(capacity)
+        case 'bloom':
+            return Windowed(capacity, window)
+        case _:
+            raise exceptions.EventerException(f'dedupe not implemented: {kind}')
@@ -0,0 +1,324 @@
+"""
+Asyncio Kinesis consumer and replayer, on aiobotocore. Same storage, checkpoints
+and sends as the kinesis eventer, reached with eventers.client('aiokinesis', action=...).
+"""
+import os
+import time
+import asyncio
+import logging
+import tempfile
+from collections import deque
+
+from eventreplay import clients, metrics
+from eventreplay.eventers import base, kinesis
+from eventreplay.eventers.kinesis import KinesisRecord
+from eventreplay.storage import checkpoint, codec, filters
+from eventreplay.storage.s3 import Reader, Writer
+from eventreplay.storage.spool import Persister
+from eventreplay import exceptions
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+
+class AsyncKinesisConsumer(base.ConsumerClient):
+    """
+    Kinesis consumer for asyncio applications, reads, stores and checkpoints as
+    kinesis.KinesisConsumer does
+
+        consumer = eventers.client('aiokinesis', action='consume', stream_name='orders', storage_destination='bucket')
+        async with contextlib.aclosing(consumer.consume()) as batches:
+            async for records in batches:
+                ...
+
+    Each open shard is read by its own task on the caller's loop, feeding a buffer
+    of `buffer_size` record batches. Records are persisted through the background
+    spool at `spool_path` and checkpoint saves run on worker threads, so S3 never
+    blocks the loop. Close the generator, eg with aclosing, to save the last
+    checkpoints and upload buffered records when stopping. KPL aggregates are
+    unpacked unless `deaggregate` is False.
+    """
+    def __init__(self, stream_name, persist_messages=True, message_store='s3', storage_destination=None, storage_options=None,
+                 fetch_limit=kinesis.FETCH_LIMIT, buffer_size=kinesis.BUFFER_SIZE, poll_interval=kinesis.POLL_INTERVAL,
+                 shard_refresh_interval=kinesis.SHARD_REFRESH_INTERVAL, checkpoint_store=None,
+                 checkpoint_destination=None, checkpoint_interval=checkpoint.CHECKPOINT_INTERVAL,
+                 checkpoint_every=checkpoint.CHECKPOINT_EVERY, deaggregate=True, spool_path=None):
+        if persist_messages and not storage_destination:
+            raise exceptions.EventerConsumerException('persist_messages needs a storage_destination bucket')
+        self.logger = logger
+        self.name = stream_name
+        self.deaggregate = deaggregate
+        self.checkpointer = checkpoint.Checkpointer(
+            checkpoint.store(checkpoint_store, checkpoint_destination, f'kinesis/{stream_name}'),
+            interval=checkpoint_interval,
+            every=checkpoint_every,
+        )
+        self.persist_messages = persist_messages
+        self.message_store = message_store
+        self.storage_destination = storage_destination
+        # storage_options are passed to the Writer, eg dict(segment=True, compression='gzip', codec='binary')
+        options = dict(storage_options or {})
+        options['codec'] = codec.get(options.get('codec'), KinesisRecord.FIELDS)
+        self.writer = Writer.from_kinesis(storage_destination, **options)
+        self.spool_path = spool_path or os.path.join(tempfile.gettempdir(), f'eventreplay-kinesis-{stream_name}.spool')
+        self.fetch_limit = fetch_limit
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.shard_refresh_interval = shard_refresh_interval
+
+    async def consume(self):
+        """
+        Gets records from the stream. This function is an async generator.
+        """
+        records = asyncio.Queue(maxsize=self.buffer_size)
+        persister = Persister(self.writer, self.spool_path) if self.persist_messages else None
+        handled = deque() # (persist ticket, shard id, position, count) of processed batches
+        try:
+            async with clients.aio_client('kinesis') as client:
+                supervisor = asyncio.create_task(self._supervise(client, records))
+                try:
+                    while True:
+                        try:
+                            item = await asyncio.wait_for(records.get(), kinesis.SUPERVISE_INTERVAL)
+                        except asyncio.TimeoutError:
+                            # saves finish in the background, checkpoint them while the stream is quiet
+                            await asyncio.to_thread(kinesis.checkpoint_saved, self.checkpointer, persister, handled)
+                            continue
+                        if isinstance(item, Exception):
+                            raise item
+                        shard_id, _records = item
+                        ticket = None
+                        if persister:
+                            started = metrics.start()
+                            ticket = persister.submit([kinesis.received_file(shard_id, record) for record in _records])
+                            metrics.observe('kinesis.persist', started, len(_records))
+                        started = metrics.start()
+                        yield _records
+                        # time the caller spent on the batch
+                        metrics.observe('kinesis.handle', started, len(_records))
+                        # the caller is back for more, so this batch has been processed
+                        handled.append((ticket, shard_id, kinesis.position(_records[-1]), len(_records)))
+                        await asyncio.to_thread(kinesis.checkpoint_saved, self.checkpointer, persister, handled)
+                finally:
+                    supervisor.cancel()
+                    await asyncio.gather(supervisor, return_exceptions=True)
+        finally:
+            # upload the rest of the spool, including partially filled segments
+            if persister:
+                await asyncio.to_thread(persister.close)
+            await asyncio.to_thread(kinesis.checkpoint_saved, self.checkpointer, persister, handled)
+            await asyncio.to_thread(self.checkpointer.flush)
+
+    async def _supervise(self, client, records):
+        """
+        Periodically list shards and start a task for each shard that is ready
+        """
+        workers, finished = {}, set()
+        shards, listed = [], None
+        try:
+            while True:
+                if listed is None or time.monotonic() - listed >= self.shard_refresh_interval:
+                    shards = await self._list_shards(client)
+                    listed = time.monotonic()
+                for shard in kinesis.ready_shards(shards, workers, finished):
+                    workers[shard['ShardId']] = asyncio.create_task(self._fetch_shard(client, shard, records, finished))
+                await asyncio.sleep(kinesis.SUPERVISE_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await records.put(exceptions.EventerConsumerException(f'Error listing shards {self.name}: {e}'))
+        finally:
+            for worker in workers.values():
+                worker.cancel()
+            await asyncio.gather(*workers.values(), return_exceptions=True)
+
+    async def _list_shards(self, client):
+        shards = []
+        params = dict(StreamName=self.name)
+        while True:
+            response = await client.list_shards(**params)
+            shards.extend(response['Shards'])
+            if not response.get('NextToken'):
+                return shards
+            params = dict(NextToken=response['NextToken'])
+
+    async def _shard_iterator(self, client, shard, after=None):
+        """
+        Iterator positioned after `after`, else after the checkpoint, else at the
+        start of the shard, and the position to skip up to inside an aggregate
+        """
+        params, skip = kinesis.iterator_request(self.name, shard, after or self.checkpointer.get(shard.get('ShardId')))
+        try:
+            response = await client.get_shard_iterator(**params)
+        except Exception as e:
+            raise exceptions.EventerConsumerException(f'Error getting shard iterator {self.name}: {e}')
+        return response['ShardIterator'], skip
+
+    async def _fetch_shard(self, client, shard, records, finished):
+        """
+        Read loop for a single shard. Exits once the shard is closed and drained.
+        """
+        shard_id = shard.get('ShardId')
+        errors = client.exceptions
+        fetched_position = None
+        try:
+            shard_iter, skip = await self._shard_iterator(client, shard)
+            while shard_iter is not None:
+                fetched = time.monotonic()
+                started = metrics.start()
+                try:
+                    response = await client.get_records(ShardIterator=shard_iter, Limit=self.fetch_limit)
+                except errors.ProvisionedThroughputExceededException:
+                    metrics.incr('kinesis.throttled')
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                except errors.ExpiredIteratorException:
+                    shard_iter, skip = await self._shard_iterator(client, shard, after=fetched_position)
+                    continue
+                shard_iter = response.get('NextShardIterator')
+                metrics.observe('kinesis.get_records', started, len(response['Records']))
+                _records = kinesis.fetched_records(response, self.deaggregate, skip)
+                if response['Records']:
+                    skip = None
+                if _records:
+                    fetched_position = kinesis.position(_records[-1])
+                    await records.put((shard_id, _records))
+                await asyncio.sleep(kinesis.fetch_delay(response, fetched, self.poll_interval))
+            self.logger.info('shard closed and drained: %s', shard_id)
+            finished.add(shard_id)
+        except asyncio.CancelledError:
+            raise
+        except exceptions.EventerConsumerException as e:
+            await records.put(e)
+        except Exception as e:
+            await records.put(exceptions.EventerConsumerException(f'Couldn\'t get records from stream {self.name}: {e}'))
+
+
+class AsyncKinesisReplayer(base.ReplayerClient):
+    """
+    Replay to given stream for given time range, on the caller's event loop
+
+        summary = await eventers.client('aiokinesis', action='replay', stream_name='orders').replay(start, end, bucket)
+
+    Sends the same PutRecords requests as kinesis.KinesisReplayer on `concurrency`
+    lanes, one request in flight per lane, keeping each partition key's order when
+    `ordered` is set. Stored objects are fetched by the Reader's thread pool.
+    Pacing and aggregation are only supported by KinesisReplayer.
+    """
+    def __init__(self, **params):
+        self.logger = logger
+        self.stream_name = params.get('stream_name')
+        self.concurrency = params.get('concurrency', kinesis.PUT_CONCURRENCY)
+        self.max_retries = params.get('max_retries', kinesis.PUT_MAX_RETRIES)
+        self.ordered = params.get('ordered', True)
+        # storage_options are passed to the Reader, eg dict(concurrency=16)
+        self.storage_options = params.get('storage_options') or {}
+        unsupported = [name for name in ('speed', 'rate', 'aggregate') if params.get(name)]
+        if unsupported:
+            raise exceptions.EventerReplayerException(f'not supported by the asyncio replayer: {", ".join(unsupported)}')
+
+    async def replay(self, start, end, bucket, where=None):
+        """
+        Replay interface
+        """
+        reader = Reader(bucket, start, end, eventer='kinesis', timestamp=kinesis.stored_time,
+                        where=filters.Filter(where, KinesisRecord.FIELDS) if where else None,
+                        **self.storage_options)
+        self.logger.info('publishing records to stream: %s', self.stream_name)
+        summary = base.ReplaySummary()
+        started = time.monotonic()
+        lanes = [asyncio.Queue(maxsize=kinesis.LANE_BUFFER) for _ in range(self.concurrency)]
+        async with clients.aio_client('kinesis') as client:
+            publishers = [asyncio.create_task(self._publish(client, lane, summary)) for lane in lanes]
+            try:
+                ind = 0
+                async for _, stored in base.in_thread(reader.objects()):
+                    for data in stored:
+                        record = KinesisRecord.from_binary(data)
+                        index = kinesis.lane_index(record, ind, len(lanes), self.ordered)
+                        await self._put(lanes[index], record, publishers[index])
+                        ind += 1
+                for lane, publisher in zip(lanes, publishers):
+                    await self._put(lane, None, publisher)
+                await asyncio.gather(*publishers)
+            except BaseException:
+                for publisher in publishers:
+                    publisher.cancel()
+                raise
+        summary.elapsed = time.monotonic() - started
+        kinesis.count_put(summary)
+        if summary.sent or summary.failed:
+            self.logger.info('Published %d records to stream: %s; failed: %d; retried: %d',
+                             summary.sent, self.stream_name, summary.failed, summary.retried)
+        else:
+            self.logger.info('No records found')
+        return summary
+
+    async def _publish(self, client, lane, summary):
+        """
+        Send the records of one lane. The lane ends with None.
+        """
+        backlog = deque() # [record, attempts], retries go back to the front
+        lane_open = True
+        while lane_open or backlog:
+            lane_open = lane_open and await self._fill(lane, backlog)
+            batch = kinesis.pack(backlog, summary, self.ordered)
+            if not batch:
+                continue
+            started = metrics.start()
+            try:
+                response = await client.put_records(
+                    StreamName=self.stream_name,
+                    Records=[record.to_entry() for record, _ in batch],
+                )
+                results = response['Records']
+                metrics.observe('kinesis.put_records', started, len(batch))
+            except Exception as e:
+                metrics.incr('kinesis.put_errors')
+                self.logger.error('Error replaying to Kinesis: %s ', e)
+                results = [{'ErrorCode': 'RequestFailed'}] * len(batch)
+            backoff = kinesis.requeue(backlog, batch, results, summary, self.max_retries)
+            if backoff:
+                await asyncio.sleep(backoff)
+
+    @staticmethod
+    async def _put(lane, record, publisher):
+        """
+        Put on a lane, raising the exception of its publisher if that stopped rather
+        than waiting on a lane nothing drains
+        """
+        try:
+            lane.put_nowait(record)
+            return
+        except asyncio.QueueFull:
+            pass
+        put = asyncio.create_task(lane.put(record))
+        await asyncio.wait((put, publisher), return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            publisher.result()
+            raise exceptions.EventerReplayerException('publisher stopped before its lane ended')
+
+    @staticmethod
+    async def _fill(lane, backlog):
+        """
+        Top up the backlog from the lane, returns False once the lane has ended
+        """
+        if not backlog:
+            record = await lane.get()
+            if record is None:
+                return False
+            backlog.append([record, 0])
+        return kinesis.top_up(backlog, lane.get_nowait, asyncio.QueueEmpty)
+
+
+def client(**kwargs):
+    """docstring"""
+    action = kwargs.pop('action', None)
+    match action:
+        case 'consume':
+            return AsyncKinesisConsumer(**kwargs)
+        case 'replay':
+            return AsyncKinesisReplayer(**kwargs)
+        case _:
+            raise exceptions.EventerException('action not implemented')
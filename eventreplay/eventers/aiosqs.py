@@ -0,0 +1,234 @@
+"""
+Asyncio SQS consumer and replayer, on aiobotocore. Same storage and sends as the
+sqs eventer, reached with eventers.client('aiosqs', action=...).
+"""
+import os
+import time
+import asyncio
+import logging
+import tempfile
+
+from eventreplay import clients, metrics
+from eventreplay import dedupe as seen_ids
+from eventreplay.eventers import base, sqs
+from eventreplay.eventers.sqs import SQSMessage
+from eventreplay.storage import codec, filters
+from eventreplay.storage.s3 import Reader, Writer
+from eventreplay.storage.spool import Persister
+from eventreplay import exceptions
+
+RECEIVERS = 4 # receive_message calls in flight
+BUFFER_SIZE = 20 # received batches held between the receivers and the caller
+SEND_CONCURRENCY = 32 # send_message_batch calls in flight
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+
+class AsyncSQSConsumer(base.ConsumerClient):
+    """
+    SQS worker for asyncio applications, stores messages as sqs.SQSConsumer does
+
+        consumer = eventers.client('aiosqs', action='consume', queue_name='orders', storage_destination='bucket')
+        async with contextlib.aclosing(consumer.consume()) as bodies:
+            async for body in bodies:
+                ...
+
+    `receivers` receive_message calls run at once on the caller's loop and fill a
+    buffer of `buffer_size` batches, so a slow caller pauses them. Messages are
+    persisted through the same background spool as SQSConsumer, and deleted by a
+    separate task once the caller asks for the message after them. Close the
+    generator, eg with aclosing, to upload the rest of the spool when stopping.
+    """
+    def __init__(self, queue_name, persist_messages=True, message_store='s3', storage_destination=None, storage_options=None,
+                 spool_path=None, dedupe='lru', dedupe_capacity=seen_ids.DEDUPE_CAPACITY,
+                 dedupe_window=seen_ids.DEDUPE_WINDOW, receivers=RECEIVERS, buffer_size=BUFFER_SIZE):
+        self.queue = queue_name
+        # storage_options are passed to the Writer, eg dict(segment=True, compression='gzip', codec='binary')
+        options = dict(storage_options or {})
+        options['codec'] = codec.get(options.get('codec', 'json'), SQSMessage.FIELDS)
+        self.writer = Writer.from_sqs(storage_destination, **options)
+        self.persist_messages = persist_messages
+        self.message_store = message_store
+        self.logger = logger
+        self.visibility_timeout = 180
+        self.max_number_of_messages = sqs.RECEIVE_BATCH_SIZE
+        self.wait_time_seconds = sqs.RECEIVE_WAIT
+        self.spool_path = spool_path or os.path.join(tempfile.gettempdir(), f'eventreplay-sqs-{queue_name}.spool')
+        self.seen = seen_ids.get(dedupe, dedupe_capacity, dedupe_window)
+        self.receivers = receivers
+        self.buffer_size = buffer_size
+
+    async def consume(self):
+        self.logger.info('Consuming from queue %s', self.queue)
+        persister = Persister(self.writer, self.spool_path) if self.persist_messages else None
+        batches = asyncio.Queue(maxsize=self.buffer_size)
+        # bounded so deletes falling behind pause the caller rather than pile up
+        deletes = asyncio.Queue(maxsize=self.buffer_size)
+        try:
+            async with clients.aio_client('sqs', **sqs.SQS_SETTINGS) as client:
+                queue_url = (await client.get_queue_url(QueueName=self.queue))['QueueUrl']
+                receivers = [asyncio.create_task(self._receive(client, queue_url, batches)) for _ in range(self.receivers)]
+                deleter = asyncio.create_task(self._delete(client, queue_url, deletes)) if sqs.DELETE_MESSAGES else None
+                try:
+                    while True:
+                        messages = await batches.get()
+                        if isinstance(messages, Exception):
+                            raise messages
+                        if persister:
+                            started = metrics.start()
+                            self._persist(persister, messages)
+                            metrics.observe('sqs.persist', started, len(messages))
+                        for message in messages:
+                            started = metrics.start()
+                            yield message['Body']
+                            # time the caller spent on the message
+                            metrics.observe('sqs.handle', started)
+                        if deleter:
+                            await deletes.put([message['ReceiptHandle'] for message in messages])
+                finally:
+                    for receiver in receivers:
+                        receiver.cancel()
+                    await asyncio.gather(*receivers, return_exceptions=True)
+                    if deleter:
+                        # delete what has been handled before closing the client
+                        await deletes.put(None)
+                        await deleter
+        finally:
+            # upload the rest of the spool, including partially filled segments
+            if persister:
+                await asyncio.to_thread(persister.close)
+
+    def _persist(self, persister, messages):
+        files = sqs.received_files(messages, self.seen)
+        if files:
+            persister.submit(files)
+
+    async def _receive(self, client, queue_url, batches):
+        try:
+            while True:
+                started = metrics.start()
+                response = await client.receive_message(QueueUrl=queue_url, **sqs.receive_params(self))
+                messages = response.get('Messages', [])
+                metrics.observe('sqs.receive', started, len(messages))
+                if messages:
+                    await batches.put(messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await batches.put(exceptions.EventerConsumerException(f'Couldn\'t receive messages from queue {self.queue}: {e}'))
+
+    async def _delete(self, client, queue_url, deletes):
+        """
+        Delete batches of receipt handles until None
+        """
+        while (handles := await deletes.get()) is not None:
+            entries = sqs.delete_entries(handles)
+            started = metrics.start()
+            try:
+                response = await client.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+            except Exception as e:
+                metrics.incr('sqs.delete_errors', len(entries))
+                self.logger.info('delete failure: %s;', e)
+                continue
+            metrics.observe('sqs.delete', started, len(entries))
+            sqs.count_deleted(response, entries)
+
+
+class AsyncSQSReplayer(base.ReplayerClient):
+    """
+    Replay to given queue for given time range, on the caller's event loop
+
+        summary = await eventers.client('aiosqs', action='replay', queue='orders').replay(start, end, bucket)
+
+    Sends the same SendMessageBatch batches as sqs.SQSReplayer, with up to
+    `concurrency` of them in flight. Stored objects are fetched by the Reader's
+    thread pool. `where` and `dedupe` work as for SQSReplayer, pacing and
+    journals are only supported by SQSReplayer.
+    """
+    def __init__(self, **params):
+        self.logger = logger
+        self.queue = params.get('queue')
+        self.concurrency = params.get('concurrency', SEND_CONCURRENCY)
+        self.max_retries = params.get('max_retries', sqs.SEND_MAX_RETRIES)
+        # storage_options are passed to the Reader, eg dict(concurrency=16, ordered=False)
+        self.storage_options = params.get('storage_options') or {}
+        self.dedupe = params.get('dedupe')
+        self.dedupe_capacity = params.get('dedupe_capacity', seen_ids.DEDUPE_CAPACITY)
+        unsupported = [name for name in ('speed', 'rate', 'journal') if params.get(name)]
+        if unsupported:
+            raise exceptions.EventerReplayerException(f'not supported by the asyncio replayer: {", ".join(unsupported)}')
+
+    async def replay(self, start, end, bucket, where=None):
+        """
+        Replay interface
+        """
+        summary = base.ReplaySummary()
+        where = filters.Filter(where, SQSMessage.FIELDS) if where else None
+        reader = Reader(bucket, start, end, timestamp=sqs.stored_time, where=where, **self.storage_options)
+        objects = ((key, [SQSMessage.from_binary(message) for message in messages]) for key, messages in reader.objects())
+        seen = seen_ids.get(self.dedupe, self.dedupe_capacity)
+        if seen:
+            objects = ((key, sqs.unseen(messages, seen)) for key, messages in objects)
+        messages = (message for _, messages in objects for message in messages)
+        self.logger.info('publishing message to queue: %s', self.queue)
+        started = time.monotonic()
+        slots = asyncio.Semaphore(self.concurrency)
+        sending = set()
+        async with clients.aio_client('sqs', **sqs.SQS_SETTINGS) as client:
+            queue_url = (await client.get_queue_url(QueueName=self.queue))['QueueUrl']
+            try:
+                # reading and batching stay off the loop, batches come back one at a time
+                async for batch in base.in_thread(sqs.batches([messages])):
+                    await slots.acquire()
+                    task = asyncio.create_task(self._copy(client, queue_url, batch, summary, slots))
+                    sending.add(task)
+                    task.add_done_callback(sending.discard)
+                await asyncio.gather(*sending)
+            except BaseException:
+                for task in sending:
+                    task.cancel()
+                raise
+        summary.elapsed = time.monotonic() - started
+        if summary.sent or summary.failed:
+            self.logger.info('Published %d messages to queue: %s; failed: %d; retried: %d',
+                             summary.sent, self.queue, summary.failed, summary.retried)
+        else:
+            self.logger.info('No messages found')
+        return summary
+
+    async def _copy(self, client, queue_url, messages, summary, slots):
+        outcome = base.ReplaySummary()
+        entries = sqs.send_entries(messages)
+        try:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    outcome.retried += len(entries)
+                    await asyncio.sleep(sqs.SEND_RETRY_BACKOFF * 2 ** (attempt - 1))
+                started = metrics.start()
+                try:
+                    response = await client.send_message_batch(QueueUrl=queue_url, Entries=list(entries.values()))
+                except Exception as e:
+                    metrics.incr('sqs.send_errors')
+                    self.logger.error('Error replaying to SQS: %s ', e)
+                    continue
+                metrics.observe('sqs.send', started, len(entries))
+                entries = sqs.unsent(response, entries, outcome)
+                if not entries:
+                    break
+        finally:
+            slots.release()
+        outcome.failed += len(entries)
+        summary.add(outcome)
+        sqs.count_sent(outcome)
+
+def client(**kwargs):
+    """docstring"""
+    action = kwargs.pop('action', None)
+    match action:
+        case 'consume':
+            return AsyncSQSConsumer(**kwargs)
+        case 'replay':
+            return AsyncSQSReplayer(**kwargs)
+        case _:
+            raise exceptions.EventerException('action not implemented')
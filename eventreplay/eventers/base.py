@@ -2,7 +2,9 @@
 Consumer interface
 """
 import os
+import asyncio
 import logging
+from dataclasses import dataclass
 
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 
@@ -18,6 +20,31 @@ class ConsumerClient:
         raise NotImplementedError
     
 
+@dataclass
+class ReplaySummary:
+    """
+    Outcome of a replay. `retried` counts resend attempts, not distinct messages.
+    Paced replays also report the target rate and how late messages were released.
+    """
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    elapsed: float = 0.0
+    target_rate: float = None
+    lag_mean: float = 0.0
+    lag_max: float = 0.0
+
+    @property
+    def achieved_rate(self):
+        return self.sent / self.elapsed if self.elapsed else None
+
+    def add(self, other):
+        self.sent += other.sent
+        self.failed += other.failed
+        self.retried += other.retried
+        return self
+
+
 class ReplayerClient:
     """docs"""
     def __init__(self, **params):
@@ -25,6 +52,20 @@ class ReplayerClient:
         for key, val in params.items():
             setattr(self, key, val)
 
-    def replay(self, start, end, bucket):
+    def replay(self, start, end, bucket, where=None):
         """docs"""
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+
+async def in_thread(iterable):
+    """
+    Items of a blocking iterable for `async for`, each fetched on a worker thread
+    so the event loop keeps running, eg Reader.objects()
+    """
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, done)
+        if item is done:
+            return
+        yield item
@@ -3,56 +3,465 @@ Kinesis eventing consumer and replayer
 """
 import os
 import time
+import tempfile
+import zlib
+import queue
+import base64
+import bisect
+import hashlib
 import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-
+from eventreplay import clients, kpl, metrics
 from eventreplay.eventers import base
+from eventreplay.pacing import Pacer
+from eventreplay.storage import checkpoint, codec, filters
+from eventreplay.storage.s3 import Reader, Writer, File
+from eventreplay.storage.spool import Persister
 from eventreplay import exceptions
 
-KINESIS_CLIENT = boto3.client('kinesis')
-S3_CLIENT = boto3.client('s3',
-                         region_name='us-west-2')
+FETCH_LIMIT = 1000 # records per get_records call, max 10000
+BUFFER_SIZE = 100 # record batches held between the shard workers and the caller
+POLL_INTERVAL = 1.0 # seconds between polls once a shard is caught up
+MIN_FETCH_INTERVAL = 0.2 # get_records is limited to 5 calls per second per shard
+SHARD_REFRESH_INTERVAL = 60 # seconds between list_shards calls
+SUPERVISE_INTERVAL = 1.0
+
+# PutRecords limits
+PUT_RECORDS_COUNT = 500
+PUT_RECORDS_BYTES = 5 * 1024 * 1024
+RECORD_MAX_BYTES = 1024 * 1024
+PUT_CONCURRENCY = 4
+PUT_MAX_RETRIES = 3
+PUT_RETRY_BACKOFF = 0.2 # seconds, doubled on each attempt
+LANE_BUFFER = 2 * PUT_RECORDS_COUNT
+LANE_PUT_TIMEOUT = 1.0 # seconds between checks that a full lane's publisher is still running
 
 logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
 
+class KinesisRecord():
+    """
+    Unmarshalled from storage. Records unpacked from a KPL aggregate also have a
+    sub_sequence_number, and an explicit_hash_key when the producer set one.
+    """
+    FIELDS = ('shard_id', 'sequence_number', 'sub_sequence_number', 'partition_key', 'explicit_hash_key',
+              'data', 'approximate_arrival_timestamp')
+    count = 1 # user records carried, more for an aggregate built by a replay
+
+    def __init__(self, **kwargs):
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+    @property
+    def payload(self):
+        """
+        Record data as bytes
+        """
+        return base64.b64decode(self.data)
+
+    @classmethod
+    def from_binary(cls, b):
+        """
+        instantiate class from any stored format, see storage.codec
+        """
+        return cls(**{key: val for key, val in codec.decode(b, cls.FIELDS).items() if val is not None})
+
+    @classmethod
+    def from_boto3(cls, record, shard_id):
+        """
+        instantiate class
+        """
+        fields = dict(
+            sequence_number=record['SequenceNumber'],
+            partition_key=record['PartitionKey'],
+            data=base64.b64encode(record['Data']).decode(),
+            approximate_arrival_timestamp=round(record['ApproximateArrivalTimestamp'].timestamp() * 1000),
+            shard_id=shard_id,
+        )
+        # only set for user records of an aggregate, other records are stored as before
+        if 'SubSequenceNumber' in record:
+            fields['sub_sequence_number'] = record['SubSequenceNumber']
+        if record.get('ExplicitHashKey'):
+            fields['explicit_hash_key'] = record['ExplicitHashKey']
+        return cls(**fields)
+
+    def to_boto3(self):
+        """
+        Record as returned by get_records
+        """
+        record = {
+            'SequenceNumber': self.sequence_number,
+            'PartitionKey': self.partition_key,
+            'Data': self.payload,
+            'ApproximateArrivalTimestamp': datetime.fromtimestamp(self.approximate_arrival_timestamp / 1000, tz=timezone.utc),
+        }
+        if getattr(self, 'sub_sequence_number', None) is not None:
+            record['SubSequenceNumber'] = self.sub_sequence_number
+        if getattr(self, 'explicit_hash_key', None):
+            record['ExplicitHashKey'] = self.explicit_hash_key
+        return record
+
+    def to_entry(self):
+        """
+        PutRecords request entry
+        """
+        entry = {'Data': self.payload, 'PartitionKey': self.partition_key}
+        if getattr(self, 'explicit_hash_key', None):
+            entry['ExplicitHashKey'] = self.explicit_hash_key
+        return entry
+
+def received_file(shard_id, record):
+    """
+    File to persist a get_records record under its arrival minute
+    """
+    ts = record['ApproximateArrivalTimestamp'].astimezone(timezone.utc).strftime('%Y/%m/%d/%H/%M')
+    m = KinesisRecord.from_boto3(record, shard_id)
+    # sequence numbers are only unique within a shard, and shared by the user records of an aggregate
+    name = f'{shard_id}-{record["SequenceNumber"]}'
+    if 'SubSequenceNumber' in record:
+        name = f'{name}-{record["SubSequenceNumber"]}'
+    return File(name, ts, m, m.approximate_arrival_timestamp)
+
+
+def position(record):
+    """
+    Checkpoint position of a get_records record, `sequence:sub-sequence` for a
+    user record of an aggregate
+    """
+    if 'SubSequenceNumber' in record:
+        return f'{record["SequenceNumber"]}:{record["SubSequenceNumber"]}'
+    return record['SequenceNumber']
+
+
+def resume_point(checkpoint):
+    """
+    (sequence number, sub-sequence number or None) of a checkpoint position
+    """
+    sequence_number, _, sub = checkpoint.partition(':')
+    return sequence_number, int(sub) if sub else None
+
+
+def after(record, sequence_number, sub):
+    """
+    True when a record comes after the user record at `sequence_number`, `sub`
+    """
+    return record['SequenceNumber'] != sequence_number or record.get('SubSequenceNumber', -1) > sub
+
+
+def ready_shards(shards, started, finished):
+    """
+    Shards to start reading, those neither `started` nor `finished`. After resharding
+    a child is only ready once its parents are drained, to keep key order.
+    """
+    known = {shard['ShardId'] for shard in shards}
+    ready = []
+    for shard in shards:
+        shard_id = shard['ShardId']
+        if shard_id in started or shard_id in finished:
+            continue
+        parents = [shard.get('ParentShardId'), shard.get('AdjacentParentShardId')]
+        if any(p in known and p not in finished for p in parents if p):
+            continue
+        ready.append(shard)
+    return ready
+
+
+def iterator_request(stream_name, shard, checkpoint_position=None):
+    """
+    get_shard_iterator arguments to resume after a checkpoint position, or at the
+    start of the shard, and the (sequence, sub-sequence) number to skip up to when
+    resuming inside an aggregate, else None
+    """
+    sequence_number, sub = resume_point(checkpoint_position or '')
+    iterator_type = 'AFTER_SEQUENCE_NUMBER' # resume after last record read by app
+    if sub is not None: # re-read the aggregate, skipping the user records already read
+        iterator_type = 'AT_SEQUENCE_NUMBER'
+    if not sequence_number: # start from beginning
+        sequence_number = shard.get('SequenceNumberRange').get('StartingSequenceNumber')
+        iterator_type = 'AT_SEQUENCE_NUMBER'
+    params = dict(
+        StreamName=stream_name,
+        ShardId=shard.get('ShardId'),
+        ShardIteratorType=iterator_type,
+        StartingSequenceNumber=sequence_number,
+        # ShardIteratorType="LATEST", # this will just read next incoming message to the shard
+        # ShardIteratorType="TRIM_HORIZON", # this will start from oldest record in shard
+    )
+    return params, (sequence_number, sub) if sub is not None else None
+
+
+def fetched_records(response, deaggregate, skip):
+    """
+    Records of a get_records response, unpacked when `deaggregate`, without the
+    user records up to `skip` (sequence, sub-sequence) when it is set
+    """
+    records = response['Records']
+    if deaggregate:
+        records = kpl.deaggregate(records)
+    if skip:
+        records = [record for record in records if after(record, *skip)]
+    return records
+
+
+def fetch_delay(response, fetched, poll_interval):
+    """
+    Seconds until a shard's next get_records, straight away while it is behind
+    """
+    if response['Records'] and response.get('MillisBehindLatest', 0) > 0:
+        return max(MIN_FETCH_INTERVAL - (time.monotonic() - fetched), 0)
+    return poll_interval
+
+
+def checkpoint_saved(checkpointer, persister, handled):
+    """
+    Checkpoint processed batches, oldest first, up to the first whose records aren't
+    in storage yet. `handled` holds (persist ticket, shard id, position, count),
+    without a persister batches are checkpointed straight away.
+    """
+    while handled and (persister is None or persister.saved(handled[0][0])):
+        _, shard_id, checkpoint_position, count = handled.popleft()
+        checkpointer.update(shard_id, checkpoint_position, count)
+
+
+def list_shards(kinesis_client, stream_name):
+    """
+    All shards of a stream, open and closed
+    """
+    shards = []
+    params = dict(StreamName=stream_name)
+    while True:
+        response = kinesis_client.list_shards(**params)
+        shards.extend(response['Shards'])
+        if not response.get('NextToken'):
+            return shards
+        params = dict(NextToken=response['NextToken'])
+
+
+def hash_ranges(shards):
+    """
+    (starting hash keys, shard ids) of the open shards in list_shards output, for `aggregated`
+    """
+    open_shards = sorted(
+        (int(shard['HashKeyRange']['StartingHashKey']), shard['ShardId'])
+        for shard in shards if 'EndingSequenceNumber' not in shard.get('SequenceNumberRange', {})
+    )
+    return [start for start, _ in open_shards], [shard_id for _, shard_id in open_shards]
+
+
+def aggregated(records, ranges, max_bytes=kpl.MAX_BYTES):
+    """
+    KPL aggregates of `records`, one open aggregate per target shard so every user
+    record lands on the shard its partition key maps to. Aggregates are routed
+    with an ExplicitHashKey inside their shard and use the shard id as partition
+    key, so replays keep one aggregate per shard in flight when ordered.
+    """
+    starts, shard_ids = ranges
+    open_aggregates = {} # shard index -> (aggregator, first record)
+    def finish(index):
+        aggregator, first = open_aggregates.pop(index)
+        return KinesisRecord(
+            sequence_number=first.sequence_number,
+            partition_key=shard_ids[index],
+            explicit_hash_key=str(starts[index]),
+            data=base64.b64encode(aggregator.data()).decode(),
+            approximate_arrival_timestamp=first.approximate_arrival_timestamp,
+            count=len(aggregator),
+        )
+    for record in records:
+        explicit_hash_key = getattr(record, 'explicit_hash_key', None)
+        hash_key = int(explicit_hash_key) if explicit_hash_key else int(hashlib.md5(record.partition_key.encode('utf-8')).hexdigest(), 16)
+        index = bisect.bisect_right(starts, hash_key) - 1
+        payload = record.payload
+        if index in open_aggregates and not open_aggregates[index][0].fits(record.partition_key, payload, explicit_hash_key):
+            yield finish(index)
+        if index not in open_aggregates:
+            open_aggregates[index] = (kpl.Aggregator(max_bytes), record)
+        open_aggregates[index][0].add(record.partition_key, payload, explicit_hash_key)
+    for index in list(open_aggregates):
+        yield finish(index)
+
+
+def stored_time(data):
+    """
+    ApproximateArrivalTimestamp of a stored record, epoch ms
+    """
+    return KinesisRecord.from_binary(data).approximate_arrival_timestamp
+
+
+def pack(backlog, summary, ordered):
+    """
+    Take the next PutRecords request's worth of [record, attempts] entries off the
+    backlog. When `ordered`, at most one record per partition key.
+    """
+    batch, keys, size, skipped = [], set(), 0, deque()
+    while backlog and len(batch) < PUT_RECORDS_COUNT:
+        entry = backlog.popleft()
+        record = entry[0]
+        length = len(record.payload) + len(record.partition_key.encode('utf-8'))
+        if length > RECORD_MAX_BYTES:
+            logger.error('Error replaying to Kinesis: record %s is too large', record.sequence_number)
+            summary.failed += record.count
+            continue
+        if size + length > PUT_RECORDS_BYTES:
+            backlog.appendleft(entry)
+            break
+        if ordered and record.partition_key in keys:
+            skipped.append(entry)
+            continue
+        keys.add(record.partition_key)
+        batch.append(entry)
+        size += length
+    backlog.extendleft(reversed(skipped))
+    return batch
+
+
+def lane_index(record, ind, lanes, ordered):
+    """
+    Lane of the `ind`th record, by partition key when `ordered`
+    """
+    if ordered:
+        return zlib.crc32(record.partition_key.encode('utf-8')) % lanes
+    return ind % lanes
+
+
+def top_up(backlog, get_nowait, empty):
+    """
+    Move records from a lane to the backlog without waiting, up to LANE_BUFFER.
+    `get_nowait` raises `empty` once the lane is empty and returns None at its
+    end. Returns False once the lane has ended.
+    """
+    while len(backlog) < LANE_BUFFER:
+        try:
+            record = get_nowait()
+        except empty:
+            return True
+        if record is None:
+            return False
+        backlog.append([record, 0])
+    return True
+
+
+def requeue(backlog, batch, results, summary, max_retries):
+    """
+    Count a PutRecords response and put the records worth retrying back at the
+    front of the backlog. Returns the seconds to back off, 0 when none are retried.
+    """
+    retry = retries(batch, results, summary, max_retries)
+    if not retry:
+        return 0
+    summary.retried += len(retry)
+    backlog.extendleft(reversed(retry))
+    return PUT_RETRY_BACKOFF * 2 ** (max(entry[1] for entry in retry) - 1)
+
+
+def count_put(summary):
+    """
+    Add a lane's or replay's sends to the metrics
+    """
+    metrics.incr('kinesis.sent', summary.sent)
+    metrics.incr('kinesis.put_failed', summary.failed)
+    metrics.incr('kinesis.put_retried', summary.retried)
+
+
+def retries(batch, results, summary, max_retries):
+    """
+    Entries of a PutRecords request worth sending again, the rest are counted
+    """
+    retry = []
+    for entry, result in zip(batch, results):
+        if 'ErrorCode' not in result:
+            summary.sent += entry[0].count
+        elif entry[1] < max_retries:
+            entry[1] += 1
+            retry.append(entry)
+        else:
+            logger.error('Error replaying to Kinesis: %s %s', result.get('ErrorCode'), result.get('ErrorMessage'))
+            summary.failed += entry[0].count
+    return retry
+
+
 class KinesisConsumer(base.ConsumerClient):
-    """Encapsulates a Kinesis stream."""
+    """
+    Encapsulates a Kinesis stream.
 
-    def __init__(self, stream_name, persist_messages=True, message_store='s3', storage_destination=None):
+    Each open shard is read by its own worker thread. Workers fetch again straight
+    away while `MillisBehindLatest` shows a backlog and wait `poll_interval` seconds
+    once caught up. Record batches are passed to the caller through a queue of
+    `buffer_size` batches, so slow callers pause the workers. Shards are re-listed
+    every `shard_refresh_interval` seconds, child shards start once their parents
+    are drained.
+
+    Records are persisted by the same background spool as SQSConsumer, at
+    `spool_path`, so S3 never holds up consumption.
+
+    Shard positions are checkpointed once the caller has processed a batch, i.e. when
+    it asks for the next one, and its records are saved to storage. Checkpoints are
+    saved to `checkpoint_store` ('file' or 's3', at `checkpoint_destination`) every
+    `checkpoint_interval` seconds or every `checkpoint_every` records. On startup
+    each shard resumes after its checkpoint.
+
+    With `deaggregate` (the default) KPL aggregated records are unpacked, so callers
+    and storage see the producer's user records. Checkpoints then record the
+    sub-sequence number too, and a shard stopped part way through an aggregate
+    resumes at the next user record.
+    """
+
+    def __init__(self, stream_name, persist_messages=True, message_store='s3', storage_destination=None, storage_options=None,
+                 fetch_limit=FETCH_LIMIT, buffer_size=BUFFER_SIZE, poll_interval=POLL_INTERVAL,
+                 shard_refresh_interval=SHARD_REFRESH_INTERVAL, checkpoint_store=None,
+                 checkpoint_destination=None, checkpoint_interval=checkpoint.CHECKPOINT_INTERVAL,
+                 checkpoint_every=checkpoint.CHECKPOINT_EVERY, deaggregate=True, spool_path=None):
         """docstring"""
         # TODO: call base.__init__
         self.logger = logger # remove once you call base.__init__
-        self.kinesis_client = KINESIS_CLIENT
-        self.s3_client = S3_CLIENT
+        if persist_messages and not storage_destination:
+            raise exceptions.EventerConsumerException('persist_messages needs a storage_destination bucket')
+        self.deaggregate = deaggregate
+        self.kinesis_client = clients.client('kinesis')
         self.name = stream_name
         self.stream_exists_waiter = self.kinesis_client.get_waiter("stream_exists")
-        self.next_sequence_number = {}
+        self.checkpointer = checkpoint.Checkpointer(
+            checkpoint.store(checkpoint_store, checkpoint_destination, f'kinesis/{stream_name}'),
+            interval=checkpoint_interval,
+            every=checkpoint_every,
+        )
         self.next_shard_iterator = {}
         self.persist_messages = persist_messages
         self.message_store = message_store
         self.storage_destination = storage_destination
-
+        # storage_options are passed to the Writer, eg dict(segment=True, compression='gzip', codec='binary')
+        options = dict(storage_options or {})
+        options['codec'] = codec.get(options.get('codec'), KinesisRecord.FIELDS)
+        self.writer = Writer.from_kinesis(storage_destination, **options)
+        self.spool_path = spool_path or os.path.join(tempfile.gettempdir(), f'eventreplay-kinesis-{stream_name}.spool')
+        self.fetch_limit = fetch_limit
+        self.poll_interval = poll_interval
+        self.shard_refresh_interval = shard_refresh_interval
+        self.records = queue.Queue(maxsize=buffer_size)
+        self.workers = {}
+        self.finished_shards = set()
+        self._stop = threading.Event()
 
     def _get_sequence_number(self, shard_id):
-        """need to persist somwhere like s3 or EFS"""
-        return self.next_sequence_number.get(shard_id, None)
+        """Last checkpointed sequence number for the shard"""
+        return self.checkpointer.get(shard_id)
     
-    def _set_sequence_number(self, shard_id, sequence_number):
+    def _set_sequence_number(self, shard_id, sequence_number, count=1):
         """
-        need to persist somwhere like s3 or EFS
-        Checkpoint shard position. For this to be of any use, can't store in memory.
+        Checkpoint shard position. Saved to the checkpoint store in batches.
         """
-        self.next_sequence_number.setdefault(shard_id, "")
-        self.next_sequence_number[shard_id] = sequence_number
+        self.checkpointer.update(shard_id, sequence_number, count)
 
     def _get_next_shard_iterator(self, shard_id):
-        """need to persist somwhere like s3 or EFS"""
+        """Iterators expire after 5 minutes so these stay in memory"""
         return self.next_shard_iterator.get(shard_id, None)
     
     def _set_next_shard_iterator(self, shard_id, next_shard_iterator):
-        """need to persist somwhere like s3 or EFS"""
+        """Iterators expire after 5 minutes so these stay in memory"""
         self.next_shard_iterator.setdefault(shard_id, "")
         self.next_shard_iterator[shard_id] = next_shard_iterator
 
@@ -60,60 +469,322 @@ class KinesisConsumer(base.ConsumerClient):
         """
         Gets records from the stream. This function is a generator.
         """
-        shards = self.kinesis_client.list_shards(
-            StreamName=self.name,
-        )['Shards']
+        self._stop.clear()
+        persister = Persister(self.writer, self.spool_path) if self.persist_messages else None
+        handled = deque() # (persist ticket, shard id, position, count) of processed batches
+        supervisor = threading.Thread(target=self._supervise, name=f'kinesis-{self.name}', daemon=True)
+        supervisor.start()
+        try:
+            while True:
+                try:
+                    item = self.records.get(timeout=SUPERVISE_INTERVAL)
+                except queue.Empty:
+                    # saves finish in the background, checkpoint them while the stream is quiet
+                    checkpoint_saved(self.checkpointer, persister, handled)
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                shard_id, _records = item
+                ticket = None
+                if persister:
+                    started = metrics.start()
+                    ticket = persister.submit([received_file(shard_id, record) for record in _records])
+                    metrics.observe('kinesis.persist', started, len(_records))
+                started = metrics.start()
+                yield _records
+                # time the caller spent on the batch
+                metrics.observe('kinesis.handle', started, len(_records))
+                # the caller is back for more, so this batch has been processed
+                handled.append((ticket, shard_id, position(_records[-1]), len(_records)))
+                checkpoint_saved(self.checkpointer, persister, handled)
+        finally:
+            self._stop.set()
+            # upload the rest of the spool, including partially filled segments
+            if persister:
+                persister.close()
+            checkpoint_saved(self.checkpointer, persister, handled)
+            self.checkpointer.flush()
 
-        while True:
-            for shard in shards:
-                shard_id = shard.get('ShardId')
-                # TODO: need to set set sequence nubmer below
-                sequence_number = self._get_sequence_number(shard_id)
-                if sequence_number is None: # start from beginning
-                    sequence_number = shard.get('SequenceNumberRange').get('StartingSequenceNumber')
-                shard_iter = self._get_next_shard_iterator(shard_id)
-                if shard_iter is None:
-                    try:
-                        shard_iter = self.kinesis_client.get_shard_iterator(
-                                StreamName=self.name,
-                                ShardId=shard_id,
-                                ShardIteratorType='AT_SEQUENCE_NUMBER', # use this when you have last latest message read by app (or use starting sequence number)
-                                StartingSequenceNumber=sequence_number,
-                                # ShardIteratorType="AFTER_SEQUENCE_NUMBER",
-                                # ShardIteratorType="LATEST", # this will just read next incoming message to the shard
-                                # ShardIteratorType="TRIM_HORIZON", # this will start from oldest record in shard
-                            )["ShardIterator"]
-                    except Exception as e:
-                        raise exceptions.EventerConsumerException(f'Error getting shard iterator {self.name}: {e}')
-                self.logger.info('fetching records - shard: %s; sequence_number: %s', shard_id, sequence_number)
+    def _supervise(self):
+        """
+        Periodically list shards and start a worker for each shard that is ready
+        """
+        shards, listed = [], None
+        try:
+            while not self._stop.is_set():
+                if listed is None or time.monotonic() - listed >= self.shard_refresh_interval:
+                    shards = self._list_shards()
+                    listed = time.monotonic()
+                self._start_workers(shards)
+                self._stop.wait(SUPERVISE_INTERVAL)
+        except Exception as e:
+            self._put(exceptions.EventerConsumerException(f'Error listing shards {self.name}: {e}'))
+
+    def _list_shards(self):
+        return list_shards(self.kinesis_client, self.name)
+
+    def _start_workers(self, shards):
+        for shard in ready_shards(shards, self.workers, self.finished_shards):
+            shard_id = shard['ShardId']
+            worker = threading.Thread(target=self._fetch_shard, args=(shard,), name=f'kinesis-{shard_id}', daemon=True)
+            self.workers[shard_id] = worker
+            worker.start()
+
+    def _shard_iterator(self, shard, after=None):
+        """
+        Iterator positioned after `after`, else after the checkpoint, else at the
+        start of the shard. Also returns the (sequence, sub-sequence) number to skip
+        up to when resuming inside an aggregate, else None.
+        """
+        shard_id = shard.get('ShardId')
+        shard_iter = self._get_next_shard_iterator(shard_id)
+        if shard_iter is not None:
+            return shard_iter, None
+        params, skip = iterator_request(self.name, shard, after or self._get_sequence_number(shard_id))
+        try:
+            return self.kinesis_client.get_shard_iterator(**params)["ShardIterator"], skip
+        except Exception as e:
+            raise exceptions.EventerConsumerException(f'Error getting shard iterator {self.name}: {e}')
+
+    def _fetch_shard(self, shard):
+        """
+        Worker loop for a single shard. Exits once the shard is closed and drained.
+        """
+        shard_id = shard.get('ShardId')
+        errors = self.kinesis_client.exceptions
+        fetched_position = None
+        try:
+            shard_iter, skip = self._shard_iterator(shard)
+            while shard_iter is not None and not self._stop.is_set():
+                fetched = time.monotonic()
+                self.logger.debug('fetching records - shard: %s', shard_id)
+                started = metrics.start()
                 try:
                     response = self.kinesis_client.get_records(
-                        ShardIterator=shard_iter, Limit=10
+                        ShardIterator=shard_iter, Limit=self.fetch_limit
                     )
-                    shard_iter = response['NextShardIterator']
-                    self._set_next_shard_iterator(shard_id, shard_iter)
-                    _records = response['Records']
-                    if self.persist_messages:
-                        # self.s3_client.put_object(Body=)
-                        print('TODO: persist messages')
-                    if _records:
-                        # optionally store these messages in S3 for replay
-                        yield _records
-                    time.sleep(3)
-                except Exception as e:
-                    raise exceptions.EventerConsumerException(f'Couldn\'t get records from stream {self.name}: {e}')
+                except errors.ProvisionedThroughputExceededException:
+                    metrics.incr('kinesis.throttled')
+                    self._stop.wait(self.poll_interval)
+                    continue
+                except errors.ExpiredIteratorException:
+                    self._set_next_shard_iterator(shard_id, None)
+                    shard_iter, skip = self._shard_iterator(shard, after=fetched_position)
+                    continue
+                shard_iter = response.get('NextShardIterator')
+                self._set_next_shard_iterator(shard_id, shard_iter)
+                metrics.observe('kinesis.get_records', started, len(response['Records']))
+                _records = fetched_records(response, self.deaggregate, skip)
+                if response['Records']:
+                    skip = None
+                if _records:
+                    fetched_position = position(_records[-1])
+                    self._put((shard_id, _records))
+                self._stop.wait(fetch_delay(response, fetched, self.poll_interval))
+            if shard_iter is None:
+                self.logger.info('shard closed and drained: %s', shard_id)
+                self.finished_shards.add(shard_id)
+        except exceptions.EventerConsumerException as e:
+            self._put(e)
+        except Exception as e:
+            self._put(exceptions.EventerConsumerException(f'Couldn\'t get records from stream {self.name}: {e}'))
+
+    def _put(self, item):
+        """
+        Hand an item to the consumer, waiting while the buffer is full
+        """
+        while not self._stop.is_set():
+            try:
+                self.records.put(item, timeout=SUPERVISE_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+class KinesisSource(base.ConsumerClient):
+    """
+    Stored records for a time range, consumed like KinesisConsumer.consume but read
+    straight from storage. Yields lists of up to `batch_size` records shaped like
+    get_records output. Batches mix shards, records keep their stored order.
+    """
+    def __init__(self, bucket, start, end, batch_size=FETCH_LIMIT, where=None, storage_options=None):
+        self.bucket = bucket
+        self.start = start
+        self.end = end
+        self.batch_size = batch_size
+        self.where = filters.Filter(where, KinesisRecord.FIELDS) if where else None
+        # storage_options are passed to the Reader, eg dict(concurrency=16, manifest=True)
+        self.storage_options = storage_options or {}
+        self.logger = logger
+
+    def consume(self):
+        self.logger.info('Consuming stored records from s3://%s for %s - %s', self.bucket, self.start, self.end)
+        reader = Reader(self.bucket, self.start, self.end, eventer='kinesis',
+                        timestamp=stored_time,
+                        where=self.where, **self.storage_options)
+        batch = []
+        for data in reader.read():
+            batch.append(KinesisRecord.from_binary(data).to_boto3())
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
 
 class KinesisReplayer(base.ReplayerClient):
-    "docstring"
+    """
+    Replay to given stream for given time range.
+
+    Records are packed into PutRecords requests of up to 500 records and 5 MB, and
+    only the failed records of a response are retried. With `ordered` set, records
+    are spread over `concurrency` lanes by partition key. Each lane sends one request
+    at a time with at most one record per partition key, so a key's records land in
+    their original order even when some of them have to be retried.
+
+    `speed` and `rate` pace the replay by ApproximateArrivalTimestamp, as for SQS,
+    and need the default ordered reads.
+    `where` replays only matching records, eg {'partition_key': 'a', 'data.type': 'x'}.
+
+    With `aggregate` set, records are sent as KPL aggregates of up to
+    `aggregate_bytes`, one being filled per open shard of the target stream, so
+    consumers that de-aggregate (the KCL, KinesisConsumer) see the original records
+    on the shard their partition key maps to. Aggregates are sent as they fill
+    rather than at stored times, so this can't be combined with `speed` or `rate`.
+    """
     def __init__(self, **params):
         # TODO: call base.__init__
         self.logger = logger # remove once you call base.__init__
-        self.s3_client = S3_CLIENT
-        self.sqs_client = KINESIS_CLIENT
+        self.kinesis_client = clients.client('kinesis')
+        self.stream_name = params.get('stream_name')
+        self.concurrency = params.get('concurrency', PUT_CONCURRENCY)
+        self.max_retries = params.get('max_retries', PUT_MAX_RETRIES)
+        self.ordered = params.get('ordered', True)
+        self.speed = params.get('speed')
+        self.rate = params.get('rate')
+        self.aggregate = params.get('aggregate', False)
+        self.aggregate_bytes = params.get('aggregate_bytes', kpl.MAX_BYTES)
+        if self.aggregate and (self.speed or self.rate):
+            raise exceptions.EventerException('aggregate can\'t be combined with speed or rate')
+        # storage_options are passed to the Reader, eg dict(concurrency=16)
+        self.storage_options = params.get('storage_options') or {}
+        if (self.speed or self.rate) and self.storage_options.get('ordered') is False:
+            raise exceptions.EventerReplayerException('speed and rate need ordered reads')
+
+    def replay(self, start, end, bucket, where=None):
+        """
+        Replay intgerface
+        """
+        reader = Reader(bucket, start, end, eventer='kinesis',
+                        timestamp=stored_time,
+                        where=filters.Filter(where, KinesisRecord.FIELDS) if where else None,
+                        **self.storage_options)
+        records = (KinesisRecord.from_binary(record) for record in reader.read())
+        self.logger.info('publishing records to stream: %s', self.stream_name)
+        summary = base.ReplaySummary()
+        pacer = None
+        if self.speed or self.rate:
+            pacer = Pacer(lambda record: record.approximate_arrival_timestamp / 1000, speed=self.speed, rate=self.rate)
+            records = (record for group in pacer.groups(records) for record in group)
+        if self.aggregate:
+            ranges = hash_ranges(list_shards(self.kinesis_client, self.stream_name))
+            records = aggregated(records, ranges, self.aggregate_bytes)
+        started = time.monotonic()
+        lanes = [queue.Queue(maxsize=LANE_BUFFER) for _ in range(self.concurrency)]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = [pool.submit(self._publish, lane) for lane in lanes]
+            try:
+                for ind, record in enumerate(records):
+                    index = lane_index(record, ind, len(lanes), self.ordered)
+                    self._put(lanes[index], record, futures[index])
+                for lane, future in zip(lanes, futures):
+                    self._put(lane, None, future)
+            except BaseException:
+                # end every lane so the other publishers return and the pool can shut down
+                for lane in lanes:
+                    self._end(lane)
+                raise
+            for future in futures:
+                summary.add(future.result())
+        summary.elapsed = time.monotonic() - started
+        if pacer:
+            pacer.report(summary, summary.elapsed)
+            self.logger.info('Paced replay: target rate: %.1f/s; achieved rate: %.1f/s; lag mean: %.3fs; max: %.3fs',
+                             summary.target_rate or 0, summary.achieved_rate or 0, summary.lag_mean, summary.lag_max)
+        if summary.sent or summary.failed:
+            self.logger.info('Published %d records to stream: %s; failed: %d; retried: %d',
+                             summary.sent, self.stream_name, summary.failed, summary.retried)
+        else:
+            self.logger.info('No records found')
+        return summary
 
-    def replay(self, start, end, bucket):
-        "docstring"
-        self.logger.info('running replay')
+    def _publish(self, lane):
+        """
+        Send the records of one lane. The lane ends with None.
+        """
+        summary = base.ReplaySummary()
+        backlog = deque() # [record, attempts], retries go back to the front
+        lane_open = True
+        while lane_open or backlog:
+            lane_open = lane_open and self._fill(lane, backlog)
+            batch = pack(backlog, summary, self.ordered)
+            if not batch:
+                continue
+            started = metrics.start()
+            try:
+                response = self.kinesis_client.put_records(
+                    StreamName=self.stream_name,
+                    Records=[record.to_entry() for record, _ in batch],
+                )
+                results = response['Records']
+                metrics.observe('kinesis.put_records', started, len(batch))
+            except Exception as e:
+                metrics.incr('kinesis.put_errors')
+                self.logger.error('Error replaying to Kinesis: %s ', e)
+                results = [{'ErrorCode': 'RequestFailed'}] * len(batch)
+            backoff = requeue(backlog, batch, results, summary, self.max_retries)
+            if backoff:
+                time.sleep(backoff)
+        count_put(summary)
+        return summary
+
+    @staticmethod
+    def _put(lane, record, publisher):
+        """
+        Put on a lane, raising the exception of its publisher if that stopped rather
+        than waiting on a lane nothing drains
+        """
+        while True:
+            try:
+                lane.put(record, timeout=LANE_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                if publisher.done():
+                    publisher.result()
+                    raise exceptions.EventerReplayerException('publisher stopped before its lane ended')
+
+    @staticmethod
+    def _end(lane):
+        """
+        Drop what is left on a lane and end it
+        """
+        while True:
+            try:
+                lane.get_nowait()
+            except queue.Empty:
+                break
+        lane.put_nowait(None)
+
+    @staticmethod
+    def _fill(lane, backlog):
+        """
+        Top up the backlog from the lane, returns False once the lane has ended
+        """
+        if not backlog:
+            record = lane.get()
+            if record is None:
+                return False
+            backlog.append([record, 0])
+        return top_up(backlog, lane.get_nowait, queue.Empty)
 
 def client(**kwargs):
     """docstring"""
@@ -125,6 +796,8 @@ def client(**kwargs):
             return KinesisConsumer(**kwargs)
         case 'replay':
             return KinesisReplayer(**kwargs)
+        case 'source':
+            return KinesisSource(**kwargs)
         case _:
             raise exceptions.EventerException('action not implemented')
         
\ No newline at end of file
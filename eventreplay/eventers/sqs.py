@@ -2,22 +2,51 @@
 SQS eventing consumer and replayer
 """
 import os
+import time
+import queue
 import logging
-import json
+import threading
+import tempfile
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-import boto3
-from botocore.client import Config
-
+from eventreplay import clients, metrics
+from eventreplay import dedupe as seen_ids
 from eventreplay.eventers import base
+from eventreplay.pacing import Pacer
+from eventreplay.storage import codec, filters
 from eventreplay.storage.s3 import Reader, Writer, File
+from eventreplay.storage.spool import Persister
+from eventreplay.storage.journal import Journal
 from eventreplay import exceptions
 
 DELETE_MESSAGES = False # temp for development
 
-SQS_CLIENT = boto3.resource('sqs',
-                            region_name='us-west-2',
-                            config=Config(connect_timeout=20, retries={'max_attempts': 0}))
+# SendMessageBatch limits
+SEND_BATCH_SIZE = 10
+SEND_BATCH_BYTES = 256 * 1024
+SEND_CONCURRENCY = 8
+SEND_MAX_RETRIES = 3
+SEND_RETRY_BACKOFF = 0.2 # seconds, doubled on each attempt
+
+# ReceiveMessage and DeleteMessageBatch limits
+RECEIVE_BATCH_SIZE = 10
+RECEIVE_WAIT = 5 # seconds, long polling
+DELETE_BATCH_SIZE = 10
+DELETE_INTERVAL = 0.5 # seconds a partial delete batch waits for more entries
+DELETE_QUEUE_SIZE = 1000 # receipt handles waiting to be deleted before submit blocks
+
+# concurrent receive_message loops, scaled between min_pollers and pollers
+POLLERS = 4
+MIN_POLLERS = 1
+BUFFER_SIZE = 20 # received batches held between the pollers and the caller
+SCALE_INTERVAL = 2.0 # seconds between scaling decisions
+SCALE_UP_FILL = 0.8 # mean receive batch fill above which a poller is added
+SCALE_DOWN_FILL = 0.3 # below which one is stopped
+SCALE_DOWN_BUFFER = 0.75 # buffer fill above which one is stopped, the caller is the bottleneck
+
+# resource settings, passed to clients.resource
+SQS_SETTINGS = dict(connect_timeout=20, max_attempts=0)
 
 logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
@@ -26,135 +55,601 @@ class SQSMessage():
     """
     Unmarshalled from storage
     """
-    def __init__(self, **kwargs):
-        for key, val in kwargs.items():
-            setattr(self, key, val)
+    __slots__ = ('message_id', 'body', 'attributes', 'message_attributes', 'md5_of_body')
+    FIELDS = __slots__
+
+    def __init__(self, message_id=None, body=None, attributes=None, message_attributes=None, md5_of_body=None):
+        self.message_id = message_id
+        self.body = body
+        self.attributes = attributes
+        self.message_attributes = message_attributes
+        self.md5_of_body = md5_of_body
+
+    def to_dict(self):
+        """
+        fields as a dict
+        """
+        return {field: getattr(self, field) for field in self.FIELDS}
         
     @classmethod
     def from_dict(cls, message):
         """
-        instantiate class
+        instantiate class - fields stored by older versions, eg receipt_handle, are dropped
         """
-        return cls(**message)
+        return cls(**{field: message.get(field) for field in cls.FIELDS})
     
     @classmethod
     def from_binary(cls, b):
         """
-        instantiate class
+        instantiate class from any stored format, see storage.codec
         """
-        return cls(**json.loads(b.decode()))
+        return cls.from_dict(codec.decode(b, cls.FIELDS))
     
+    @classmethod
+    def from_response(cls, message):
+        """
+        instantiate class from a receive_message response entry
+        """
+        return cls(
+            message_id=message['MessageId'],
+            body=message['Body'],
+            attributes=message.get('Attributes'),
+            message_attributes=message.get('MessageAttributes'),
+            md5_of_body=message.get('MD5OfBody'),
+        )
+
     @classmethod
     def from_boto3(cls, message):
         """
         instantiate class
         """
-        return cls(**{k: getattr(message, k) for k in dir(message) if isinstance(getattr(message, k), (str, dict)) and k[0]!= '_'})
+        return cls(
+            message_id=message.message_id,
+            body=message.body,
+            attributes=message.attributes,
+            message_attributes=message.message_attributes,
+            md5_of_body=message.md5_of_body,
+        )
+
+def stored_time(data):
+    """
+    SentTimestamp of a stored message, epoch ms
+    """
+    return int(SQSMessage.from_binary(data).attributes['SentTimestamp'])
+
+
+def received_file(message_id, sent_timestamp, message):
+    """
+    File to persist a received message under its SentTimestamp minute
+    """
+    # epoch ms - truncate rather than round so a message never lands in the next minute
+    ms = int(sent_timestamp) if len(sent_timestamp) == 13 else int(float(sent_timestamp) * 1000)
+    ts = datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime('%Y/%m/%d/%H/%M')
+    return File(message_id, ts, message, ms)
+
+
+class Deleter():
+    """
+    Deletes handled messages in the background, in batches of up to 10 entries.
+    A partial batch is sent once no more entries arrive for `interval` seconds.
+    Failed deletes are logged and counted, the messages come back once their
+    visibility timeout expires. `submit` blocks once `queue_size` handles are
+    waiting, so a consumer can't outrun its deletes.
+    """
+    def __init__(self, sqs_queue, interval=DELETE_INTERVAL, queue_size=DELETE_QUEUE_SIZE):
+        self.queue = sqs_queue
+        self.interval = interval
+        self.logger = logger
+        self.pending = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='eventreplay-sqs-delete', daemon=True)
+        self.thread.start()
+
+    def submit(self, messages):
+        for message in messages:
+            self.pending.put(message['ReceiptHandle'])
+
+    def close(self):
+        """
+        Stop the background thread once everything submitted is deleted
+        """
+        self._stop.set()
+        self.thread.join()
+
+    def _run(self):
+        handles = []
+        while True:
+            try:
+                handles.append(self.pending.get(timeout=self.interval))
+            except queue.Empty:
+                if handles:
+                    self._delete(handles)
+                    handles = []
+                if self._stop.is_set():
+                    return
+                continue
+            if len(handles) == DELETE_BATCH_SIZE:
+                self._delete(handles)
+                handles = []
+
+    def _delete(self, handles):
+        entries = delete_entries(handles)
+        started = metrics.start()
+        try:
+            response = self.queue.delete_messages(Entries=entries)
+        except Exception as e:
+            metrics.incr('sqs.delete_errors', len(entries))
+            self.logger.info('delete failure: %s;', e)
+            return
+        metrics.observe('sqs.delete', started, len(entries))
+        count_deleted(response, entries)
+
+
+def delete_entries(handles):
+    """
+    DeleteMessageBatch entries for receipt handles
+    """
+    return [{'Id': str(ind), 'ReceiptHandle': handle} for ind, handle in enumerate(handles)]
+
+
+def count_deleted(response, entries):
+    """
+    Log and count the failures of a DeleteMessageBatch response
+    """
+    failed = response.get('Failed', [])
+    if failed:
+        metrics.incr('sqs.delete_errors', len(failed))
+        logger.info('delete failure: %d of %d; %s', len(failed), len(entries), failed[0].get('Message'))
+
+
+def received_files(messages, seen=None):
+    """
+    Files to persist receive_message response entries, skipping ids `seen` before
+    """
+    files = []
+    for message in messages:
+        if seen and seen.seen(message['MessageId']):
+            metrics.incr('sqs.persist_duplicates')
+            continue
+        # TODO: pass entire message, have replayer wrap entire message and include some metadata
+        # TODO; make this consumer detect replayed message and unwrap original message
+        m = SQSMessage.from_response(message)
+        files.append(received_file(message['MessageId'], message['Attributes']['SentTimestamp'], m))
+    return files
+
+
+def receive_params(consumer):
+    """
+    receive_message arguments of an SQS consumer
+    """
+    return dict(
+        VisibilityTimeout=consumer.visibility_timeout,
+        MaxNumberOfMessages=consumer.max_number_of_messages,
+        WaitTimeSeconds=consumer.wait_time_seconds,
+        AttributeNames=['SentTimestamp'],
+        MessageAttributeNames=['All'],
+    )
+
+
+def unseen(messages, seen):
+    """
+    Messages whose ids weren't seen before, duplicates are counted
+    """
+    fresh = [message for message in messages if not seen.seen(message.message_id)]
+    if len(fresh) < len(messages):
+        metrics.incr('sqs.replay_duplicates', len(messages) - len(fresh))
+    return fresh
+
+
+def batches(groups):
+    """
+    Split each group of messages into SendMessageBatch sized batches
+    """
+    for messages in groups:
+        batch, size = [], 0
+        for message in messages:
+            length = len(message.body.encode('utf-8'))
+            if batch and (len(batch) == SEND_BATCH_SIZE or size + length > SEND_BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(message)
+            size += length
+        if batch:
+            yield batch
+
+
+def send_entries(messages):
+    """
+    SendMessageBatch entries for a batch of messages, by Id
+    """
+    return {
+        str(ind): {'Id': str(ind), 'MessageBody': message.body}
+        for ind, message in enumerate(messages)
+    }
+
+
+def unsent(response, entries, summary):
+    """
+    Entries of a send_message_batch call worth sending again, the rest are counted
+    """
+    summary.sent += len(response.get('Successful', []))
+    retry = {}
+    for failure in response.get('Failed', []):
+        if failure.get('SenderFault'):
+            # resending won't help, eg invalid message body
+            logger.error('Error replaying to SQS: %s %s', failure.get('Code'), failure.get('Message'))
+            summary.failed += 1
+        else:
+            retry[failure['Id']] = entries[failure['Id']]
+    return retry
+
+
+def count_sent(summary):
+    """
+    Add a replay's sends to the metrics
+    """
+    metrics.incr('sqs.sent', summary.sent)
+    metrics.incr('sqs.send_failed', summary.failed)
+    metrics.incr('sqs.send_retried', summary.retried)
+
 
 class SQSConsumer(base.ConsumerClient):
     """
     SQS worker - replay/storage is optional feature
+
+    Up to `pollers` threads receive from the queue at once and hand batches of up
+    to 10 messages to the caller through a buffer of `buffer_size` batches. Every
+    SCALE_INTERVAL seconds a poller is added while receives come back nearly full
+    and the buffer has room, and one is stopped while receives come back mostly
+    empty or the buffer fills up, down to `min_pollers`. Messages are deleted in
+    the background in batches once the caller asks for the message after them.
+    Messages still buffered when the caller stops are not deleted and come back
+    after the visibility timeout.
+
+    Messages are persisted by a background stage so S3 never holds up consumption.
+    Received messages are spooled to a local file at `spool_path` and uploaded from
+    there. Whatever is left in the spool is uploaded on the next start, so the path
+    must be unique to this consumer and survive restarts.
+
+    Redelivered messages are only persisted once. `dedupe` picks how recent message
+    ids are remembered: 'lru' keeps the last `dedupe_capacity` exactly, 'bloom'
+    those of the last `dedupe_window` seconds in far less memory, see eventreplay.dedupe.
+    None persists every delivery.
     """
-    def __init__(self, queue_name, persist_messages=True, message_store='s3', storage_destination=None):
+    def __init__(self, queue_name, persist_messages=True, message_store='s3', storage_destination=None, storage_options=None,
+                 spool_path=None, dedupe='lru', dedupe_capacity=seen_ids.DEDUPE_CAPACITY,
+                 dedupe_window=seen_ids.DEDUPE_WINDOW, pollers=POLLERS, min_pollers=MIN_POLLERS,
+                 buffer_size=BUFFER_SIZE):
+        if not 1 <= min_pollers <= pollers:
+            raise exceptions.EventerConsumerException(f'need 1 <= min_pollers <= pollers: {min_pollers}, {pollers}')
         self.queue = queue_name
         self.client = self._client()
-        self.writer = Writer.from_sqs(storage_destination)
+        # resources aren't thread safe, the pollers share the underlying client
+        self.receive_client = self.client.meta.client
+        self.queue_url = self.client.url
+        # storage_options are passed to the Writer, eg dict(segment=True, compression='gzip', codec='binary')
+        options = dict(storage_options or {})
+        options['codec'] = codec.get(options.get('codec', 'json'), SQSMessage.FIELDS)
+        self.writer = Writer.from_sqs(storage_destination, **options)
         self.persist_messages = persist_messages
         self.message_store = message_store
         self.logger = logger
         self.visibility_timeout=180
-        self.max_number_of_messages=5
-        self.wait_time_seconds=5
-
+        self.max_number_of_messages=RECEIVE_BATCH_SIZE
+        self.wait_time_seconds=RECEIVE_WAIT
+        self.spool_path = spool_path or os.path.join(tempfile.gettempdir(), f'eventreplay-sqs-{queue_name}.spool')
+        self.persister = None
+        self.seen = seen_ids.get(dedupe, dedupe_capacity, dedupe_window)
+        self.max_pollers = pollers
+        self.min_pollers = min_pollers
+        self.active = min_pollers
+        self.pollers = {}
+        self.batches = queue.Queue(maxsize=buffer_size)
+        self.received = [0, 0] # messages and receive calls since the last scaling decision
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
 
     def _client(self):
-        return SQS_CLIENT.get_queue_by_name(QueueName=self.queue)
+        return clients.resource('sqs', **SQS_SETTINGS).get_queue_by_name(QueueName=self.queue)
 
 
     def _persist(self, messages):
-        for message in messages:
-            sts = message.attributes.get('SentTimestamp')
-            if len(sts) == 13:
-                sts = round(int(sts)/1000)
-            ts = datetime.fromtimestamp(float(sts), tz=timezone.utc).strftime('%Y/%m/%d/%H/%M')
-            # TODO: pass entire message, have replayer wrap entire message and include some metadata
-            # TODO; make this consumer detect replayed message and unwrap original message
-            m = SQSMessage.from_boto3(message)
-            file = File(message.message_id, ts, m)
-            self.writer.buffer(file)
-        self.writer.write()
+        files = received_files(messages, self.seen)
+        if files:
+            self.persister.submit(files)
 
 
     def consume(self):
         self.logger.info('Consuming from queue %s', self.queue)
+        if self.persist_messages:
+            self.persister = Persister(self.writer, self.spool_path)
+        deleter = Deleter(self.client) if DELETE_MESSAGES else None
+        self._stop.clear()
+        self.active = self.min_pollers
+        supervisor = threading.Thread(target=self._supervise, name=f'sqs-{self.queue}', daemon=True)
+        supervisor.start()
+        try:
+            yield from self._consume(deleter)
+        finally:
+            # pollers may be waiting on a receive, they drop what they get once stopped
+            self._stop.set()
+            supervisor.join()
+            if deleter:
+                deleter.close()
+            # upload the rest of the spool, including partially filled segments
+            if self.persister:
+                self.persister.close()
+
+    def _consume(self, deleter):
         while True:
-            messages = self.client.receive_messages(
-                VisibilityTimeout=self.visibility_timeout,
-                MaxNumberOfMessages=self.max_number_of_messages,
-                WaitTimeSeconds=self.wait_time_seconds,
-                AttributeNames=['SentTimestamp'],
-            )
-            self.logger.info("message count: %d\n", len(messages))
-            if self.persist_messages and len(messages) > 0:
+            messages = self.batches.get()
+            if isinstance(messages, Exception):
+                raise messages
+            if self.persist_messages:
+                started = metrics.start()
                 self._persist(messages)
+                metrics.observe('sqs.persist', started, len(messages))
             for message in messages:
-                yield message.body
+                started = metrics.start()
+                yield message['Body']
+                # time the caller spent on the message
+                metrics.observe('sqs.handle', started)
+            if deleter:
+                deleter.submit(messages)
+
+    def _supervise(self):
+        """
+        Start pollers up to the active count and adjust it every SCALE_INTERVAL seconds
+        """
+        while not self._stop.is_set():
+            for index in range(self.active):
+                poller = self.pollers.get(index)
+                if poller is None or not poller.is_alive():
+                    poller = threading.Thread(target=self._poll, args=(index,), name=f'sqs-{self.queue}-{index}', daemon=True)
+                    self.pollers[index] = poller
+                    poller.start()
+            if self._stop.wait(SCALE_INTERVAL):
+                return
+            self._scale()
+
+    def _scale(self):
+        with self.lock:
+            count, calls = self.received
+            self.received = [0, 0]
+        if not calls:
+            return
+        fill = count / (calls * self.max_number_of_messages)
+        buffered = self.batches.qsize() / self.batches.maxsize
+        active = self.active
+        if fill >= SCALE_UP_FILL and buffered < SCALE_DOWN_BUFFER and active < self.max_pollers:
+            active += 1
+        elif (fill <= SCALE_DOWN_FILL or buffered >= SCALE_DOWN_BUFFER) and active > self.min_pollers:
+            active -= 1
+        if active != self.active:
+            self.logger.info('sqs pollers %d -> %d: receive fill %.2f, buffer fill %.2f', self.active, active, fill, buffered)
+            metrics.incr('sqs.scale_up' if active > self.active else 'sqs.scale_down')
+            self.active = active
+
+    def _poll(self, index):
+        """
+        Receive loop of one poller, it exits once its index is above the active count
+        """
+        try:
+            while not self._stop.is_set() and index < self.active:
+                started = metrics.start()
+                response = self.receive_client.receive_message(QueueUrl=self.queue_url, **receive_params(self))
+                messages = response.get('Messages', [])
+                metrics.observe('sqs.receive', started, len(messages))
+                self.logger.debug("message count: %d", len(messages))
+                with self.lock:
+                    self.received[0] += len(messages)
+                    self.received[1] += 1
+                if messages:
+                    self._put(messages)
+        except Exception as e:
+            self._put(exceptions.EventerConsumerException(f'Couldn\'t receive messages from queue {self.queue}: {e}'))
+
+    def _put(self, item):
+        """
+        Hand an item to the consumer, waiting while the buffer is full
+        """
+        while not self._stop.is_set():
             try:
-                entries = [
-                    {"Id": str(ind), "ReceiptHandle": msg.receipt_handle}
-                    for ind, msg in enumerate(messages)
-                ]
-                if len(entries) < 1 or not DELETE_MESSAGES: continue
-                self.logger.info('delete attempt')
-                self.client.delete_messages(
-                    Entries=entries
-                )
-                self.logger.info('delete success')
-            except Exception as e:
-                self.logger.info('delete failure: %s;', e)
+                self.batches.put(item, timeout=SCALE_INTERVAL)
+                return
+            except queue.Full:
                 continue
 
+class SQSSource(base.ConsumerClient):
+    """
+    Stored messages for a time range, consumed like SQSConsumer.consume but read
+    straight from storage, eg to backfill a handler without a queue in between.
+
+    Yields message bodies, or lists of up to `batch_size` bodies when it is set.
+    `where`, `dedupe` and `storage_options` are as for SQSReplayer.
+    """
+    def __init__(self, bucket, start, end, batch_size=None, where=None, dedupe=None, storage_options=None):
+        self.bucket = bucket
+        self.start = start
+        self.end = end
+        self.batch_size = batch_size
+        self.where = filters.Filter(where, SQSMessage.FIELDS) if where else None
+        self.seen = seen_ids.get(dedupe)
+        # storage_options are passed to the Reader, eg dict(concurrency=16, manifest=True)
+        self.storage_options = storage_options or {}
+        self.logger = logger
+
+    def consume(self):
+        self.logger.info('Consuming stored messages from s3://%s for %s - %s', self.bucket, self.start, self.end)
+        reader = Reader(self.bucket, self.start, self.end, timestamp=stored_time, where=self.where,
+                        **self.storage_options)
+        messages = (SQSMessage.from_binary(message) for message in reader.read())
+        if self.seen:
+            messages = (message for message in messages if not self.seen.seen(message.message_id))
+        if not self.batch_size:
+            for message in messages:
+                yield message.body
+            return
+        batch = []
+        for message in messages:
+            batch.append(message.body)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
 class SQSReplayer(base.ReplayerClient):
     """
-    Replay to given queue for given time range
+    Replay to given queue for given time range.
+
+    Messages are grouped into SendMessageBatch calls which run on a bounded pool of
+    `concurrency` senders. Failed entries of a partial batch are retried up to
+    `max_retries` times.
+
+    For load tests set `speed` to keep the original gaps between messages, going by
+    their SentTimestamp, scaled by that factor (1 is real time). `rate` caps the
+    messages sent per second. Both need the default ordered reads.
+
+    `where` replays only matching messages, eg {'message_attributes.tenant': 'acme'},
+    see storage.filters.
+
+    With `journal` set to a directory, progress is recorded there as objects are
+    sent. Set `resume` to continue an interrupted replay of the same range from
+    the first object that wasn't fully sent, instead of from `start`.
+
+    Set `dedupe` to 'lru' or 'bloom' to publish each message id once per replay, eg
+    when a consumer stored a message more than once. `dedupe_capacity` ids are kept.
     """
     def __init__(self, **params):
         # TODO: add dry-run flag
         self.logger = logger
-        self.s3_client = boto3.client('s3',region_name='us-west-2')
+        self.s3_client = clients.client('s3')
         self.queue = params.get('queue')
+        self.concurrency = params.get('concurrency', SEND_CONCURRENCY)
+        self.max_retries = params.get('max_retries', SEND_MAX_RETRIES)
+        # storage_options are passed to the Reader, eg dict(concurrency=16, ordered=False)
+        self.storage_options = params.get('storage_options') or {}
+        self.speed = params.get('speed')
+        self.rate = params.get('rate')
+        self.dedupe = params.get('dedupe')
+        self.dedupe_capacity = params.get('dedupe_capacity', seen_ids.DEDUPE_CAPACITY)
+        self.journal = params.get('journal')
+        self.resume = params.get('resume', False)
+        if self.journal and self.storage_options.get('ordered') is False:
+            raise exceptions.EventerReplayerException('journal needs ordered reads')
+        if (self.speed or self.rate) and self.storage_options.get('ordered') is False:
+            raise exceptions.EventerReplayerException('speed and rate need ordered reads')
         self.sqs_client = self._client()
+        # resources aren't thread safe, the senders share the underlying client
+        self.batch_client = self.sqs_client.meta.client
+        self.queue_url = self.sqs_client.url
 
     def _client(self):
-        return SQS_CLIENT.get_queue_by_name(QueueName=self.queue)
+        return clients.resource('sqs', **SQS_SETTINGS).get_queue_by_name(QueueName=self.queue)
 
-    def replay(self, start, end, bucket):
+    def replay(self, start, end, bucket, where=None):
         """
         Replay intgerface
         """
-        reader = Reader(bucket, start, end)
-        messages = reader.read()
+        summary = base.ReplaySummary()
+        journal = None
+        if self.journal:
+            job = dict(eventer='sqs', queue=self.queue, bucket=bucket, start=start, end=end, where=where)
+            journal = Journal(self.journal, job)
+            if self.resume:
+                journal.load()
+            if journal.complete:
+                self.logger.info('replay already complete, see %s', journal.path)
+                return summary
+        where = filters.Filter(where, SQSMessage.FIELDS) if where else None
+        reader = Reader(bucket, start, end, timestamp=stored_time, where=where,
+                        after=journal.last if journal else None, **self.storage_options)
+        objects = ((key, [SQSMessage.from_binary(message) for message in messages]) for key, messages in reader.objects())
+        seen = seen_ids.get(self.dedupe, self.dedupe_capacity)
+        if seen:
+            objects = ((key, unseen(messages, seen)) for key, messages in objects)
+        if journal:
+            messages = journal.tracked(objects)
+        else:
+            messages = (message for _, messages in objects for message in messages)
         self.logger.info('publishing message to queue: %s', self.queue)
-        i = 0
-        for message in messages:
-            i += 1
-            msg = SQSMessage.from_binary(message)
-            _ = self._copy(msg, self.queue)
-        txt = f"Successfully published {i} messages to queue" if i > 0 else "No messages found"
-        self.logger.info(txt)
-        
-    def _copy(self, message, queue):
+        pacer = None
+        groups = [messages]
+        if self.speed or self.rate:
+            pacer = Pacer(self._timestamp, speed=self.speed, rate=self.rate, group_size=SEND_BATCH_SIZE)
+            groups = pacer.groups(messages)
+        started = time.monotonic()
         try:
-            response = self.sqs_client.send_message(
-                QueueUrl = queue,
-                MessageBody = message.body,
-                # MessageAttributes = {} # TODO: set this
-                # MessageDeduplicationId = '' # TODO: set this
-                # MessageGroupId = '' # TODO: set this
-            )
-            return response
-        except Exception as e:
-            self.logger.error('Error replaying to SQS: %s ', e)
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                pending = {} # future -> (first, last + 1) message number of its batch
+                count = 0
+                for batch in batches(groups):
+                    # bound the number of batches held in memory
+                    if len(pending) >= self.concurrency * 2:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        self._collect(done, pending, summary, journal)
+                    pending[pool.submit(self._copy, batch)] = (count, count + len(batch))
+                    count += len(batch)
+                self._collect(wait(pending).done, pending, summary, journal)
+            if journal:
+                journal.finish()
+        finally:
+            if journal and not journal.complete:
+                journal.flush()
+        summary.elapsed = time.monotonic() - started
+        if pacer:
+            pacer.report(summary, summary.elapsed)
+            self.logger.info('Paced replay: target rate: %.1f/s; achieved rate: %.1f/s; lag mean: %.3fs; max: %.3fs',
+                             summary.target_rate or 0, summary.achieved_rate or 0, summary.lag_mean, summary.lag_max)
+        if summary.sent or summary.failed:
+            self.logger.info('Published %d messages to queue: %s; failed: %d; retried: %d',
+                             summary.sent, self.queue, summary.failed, summary.retried)
+        else:
+            self.logger.info('No messages found')
+        return summary
+
+    @staticmethod
+    def _collect(futures, pending, summary, journal):
+        for future in futures:
+            first, end = pending.pop(future)
+            result = future.result()
+            summary.add(result)
+            if journal:
+                journal.ack(first, end, result)
+
+    @staticmethod
+    def _timestamp(message):
+        return int(message.attributes['SentTimestamp']) / 1000
+
+    def _copy(self, messages):
+        summary = base.ReplaySummary()
+        entries = send_entries(messages)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                summary.retried += len(entries)
+                time.sleep(SEND_RETRY_BACKOFF * 2 ** (attempt - 1))
+            started = metrics.start()
+            try:
+                response = self.batch_client.send_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=list(entries.values()),
+                    # MessageAttributes = {} # TODO: set this
+                    # MessageDeduplicationId = '' # TODO: set this
+                    # MessageGroupId = '' # TODO: set this
+                )
+            except Exception as e:
+                metrics.incr('sqs.send_errors')
+                self.logger.error('Error replaying to SQS: %s ', e)
+                continue
+            metrics.observe('sqs.send', started, len(entries))
+            entries = unsent(response, entries, summary)
+            if not entries:
+                break
+        summary.failed += len(entries)
+        count_sent(summary)
+        return summary
 
         
 def client(**kwargs):
@@ -167,6 +662,8 @@ def client(**kwargs):
             return SQSConsumer(**kwargs)
         case 'replay':
             return SQSReplayer(**kwargs)
+        case 'source':
+            return SQSSource(**kwargs)
         case _:
             raise exceptions.EventerException('action not implemented')
         
\ No newline at end of file
@@ -0,0 +1,138 @@
+"""
+Export stored messages for a time range to a local columnar file, Parquet or
+Arrow IPC, for bulk analysis with pyarrow, pandas, polars or duckdb.
+
+Needs pyarrow, an optional dependency: pip install -r requirements-export.txt
+
+    from eventreplay import export
+    rows = export.export('2024/10/15/00/00', '2024/10/15/23/59', bucket, 'day.parquet',
+                         fields=['body.order.type', 'message_attributes.tenant'])
+
+Messages are decoded once, straight from storage into column lists, and written
+in record batches of `batch_rows`, no message objects are built. `fields` are
+dotted paths as in storage.filters, each exported as an extra string column. A
+json body is parsed once per message for all of them.
+"""
+import os
+import json
+import base64
+import logging
+import contextlib
+
+from eventreplay import exceptions
+from eventreplay.eventers import kinesis, sqs
+from eventreplay.storage import codec, filters
+from eventreplay.storage.s3 import Reader
+
+FORMATS = ('parquet', 'arrow')
+BATCH_ROWS = 64 * 1024
+PARQUET_COMPRESSION = 'zstd'
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise exceptions.EventerException('export needs pyarrow: pip install pyarrow') from None
+    return pyarrow
+
+
+def _json(value):
+    return None if value is None else json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def _token(value):
+    return None if value is None else filters.token(value)
+
+
+def _sqs_columns(pa):
+    """
+    (name, type, value of a decoded message) for each column of an SQS export
+    """
+    return [
+        ('timestamp', pa.timestamp('ms', tz='UTC'), lambda m: int(m['attributes']['SentTimestamp'])),
+        ('message_id', pa.string(), lambda m: m['message_id']),
+        ('attributes', pa.map_(pa.string(), pa.string()), lambda m: m['attributes']),
+        ('message_attributes', pa.string(), lambda m: _json(m.get('message_attributes'))),
+        ('md5_of_body', pa.string(), lambda m: m.get('md5_of_body')),
+        ('body', pa.string(), lambda m: m['body']),
+    ]
+
+
+def _kinesis_columns(pa):
+    """
+    (name, type, value of a decoded record) for each column of a Kinesis export
+    """
+    return [
+        ('timestamp', pa.timestamp('ms', tz='UTC'), lambda r: r['approximate_arrival_timestamp']),
+        ('shard_id', pa.string(), lambda r: r.get('shard_id')),
+        ('sequence_number', pa.string(), lambda r: r['sequence_number']),
+        ('sub_sequence_number', pa.int64(), lambda r: r.get('sub_sequence_number')),
+        ('partition_key', pa.string(), lambda r: r['partition_key']),
+        ('data', pa.binary(), lambda r: base64.b64decode(r['data'])),
+    ]
+
+
+@contextlib.contextmanager
+def _open(pa, path, schema, format):
+    if format == 'parquet':
+        writer = pa.parquet.ParquetWriter(path, schema, compression=PARQUET_COMPRESSION)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+
+def export(start, end, bucket, path, eventer='sqs', format='parquet', fields=(), where=None,
+           batch_rows=BATCH_ROWS, storage_options=None):
+    """
+    Write the messages stored for start to end to `path`, returns the number of
+    rows. `where` exports only matching messages, see storage.filters, and
+    `storage_options` are passed to the Reader, eg dict(concurrency=32, manifest=True).
+    """
+    if format not in FORMATS:
+        raise exceptions.EventerException(f'export format not implemented: {format}')
+    pa = _pyarrow()
+    match eventer:
+        case 'sqs':
+            columns, stored_fields = _sqs_columns(pa), sqs.SQSMessage.FIELDS
+        case 'kinesis':
+            columns, stored_fields = _kinesis_columns(pa), kinesis.KinesisRecord.FIELDS
+        case _:
+            raise exceptions.EventerException(f'export not implemented for eventer: {eventer}')
+    schema = pa.schema([(name, kind) for name, kind, _ in columns] + [(field, pa.string()) for field in fields])
+    # the timestamp column doubles as the Reader's time filter on decoded messages
+    reader = Reader(bucket, start, end, eventer=eventer, timestamp=columns[0][2],
+                    where=filters.Filter(where, stored_fields) if where else None,
+                    decode=lambda data: codec.decode(data, stored_fields),
+                    **(storage_options or {}))
+    rows = 0
+    with _open(pa, path, schema, format) as writer:
+        batch, extras = [], []
+        for message in reader.read():
+            batch.append(message)
+            if fields:
+                documents = {}
+                extras.append([_token(filters.resolve(message, field, documents)) for field in fields])
+            if len(batch) == batch_rows:
+                writer.write_batch(_batch(pa, schema, columns, batch, extras))
+                rows += len(batch)
+                batch, extras = [], []
+        if batch:
+            writer.write_batch(_batch(pa, schema, columns, batch, extras))
+            rows += len(batch)
+    logger.info('Exported %d messages for %s - %s to %s', rows, start, end, path)
+    return rows
+
+
+def _batch(pa, schema, columns, messages, extras):
+    arrays = [pa.array([value(message) for message in messages], type=kind) for _, kind, value in columns]
+    arrays += [pa.array([row[ind] for row in extras], type=pa.string()) for ind in range(len(schema) - len(columns))]
+    return pa.record_batch(arrays, schema=schema)
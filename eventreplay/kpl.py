@@ -0,0 +1,193 @@
+"""
+Kinesis Producer Library (KPL) aggregated records. Consumers unpack records
+aggregated by KPL producers, and replays can aggregate their own.
+
+An aggregated record's data is MAGIC, a protobuf AggregatedRecord and the md5 of
+that protobuf:
+
+    message AggregatedRecord {
+        repeated string partition_key_table = 1;
+        repeated string explicit_hash_key_table = 2;
+        repeated Record records = 3;
+    }
+    message Record {
+        required uint64 partition_key_index = 1;
+        optional uint64 explicit_hash_key_index = 2;
+        required bytes data = 3;
+        repeated Tag tags = 4;
+    }
+
+The few fields needed are encoded by hand, so protobuf isn't a dependency. Tags
+are skipped.
+"""
+import hashlib
+
+MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+MAX_BYTES = 50 * 1024 # KPL's default AggregationMaxSize
+
+# protobuf wire types
+_VARINT, _FIXED64, _BYTES, _FIXED32 = 0, 1, 2, 5
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _field(number, value):
+    """
+    Length-delimited field, bytes or a str
+    """
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return _varint(number << 3 | _BYTES) + _varint(len(value)) + value
+
+
+def _fields(data):
+    """
+    (field number, value) of each field of a protobuf message, lengths checked
+    """
+    pos, end = 0, len(data)
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == _VARINT:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == _BYTES:
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == _FIXED64:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == _FIXED32:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f'unsupported wire type: {wire_type}')
+        if pos > end:
+            raise ValueError('truncated message')
+        yield number, value
+
+
+def is_aggregated(data):
+    """
+    True when record data is a KPL aggregate with a valid checksum
+    """
+    if len(data) <= len(MAGIC) + DIGEST_SIZE or not data.startswith(MAGIC):
+        return False
+    message = data[len(MAGIC):-DIGEST_SIZE]
+    return hashlib.md5(message).digest() == data[-DIGEST_SIZE:]
+
+
+def unpack(data):
+    """
+    (partition key, explicit hash key or None, data) of each user record in an aggregate
+    """
+    keys, hash_keys, records = [], [], []
+    for number, value in _fields(data[len(MAGIC):-DIGEST_SIZE]):
+        if number == 1:
+            keys.append(bytes(value).decode('utf-8'))
+        elif number == 2:
+            hash_keys.append(bytes(value).decode('utf-8'))
+        elif number == 3:
+            records.append(value)
+    for record in records:
+        key_index, hash_key_index, payload = None, None, b''
+        for number, value in _fields(record):
+            if number == 1:
+                key_index = value
+            elif number == 2:
+                hash_key_index = value
+            elif number == 3:
+                payload = bytes(value)
+        yield keys[key_index], hash_keys[hash_key_index] if hash_key_index is not None else None, payload
+
+
+def deaggregate(records):
+    """
+    get_records records with every aggregate replaced by its user records. User
+    records keep the aggregate's SequenceNumber and get a SubSequenceNumber, plus
+    an ExplicitHashKey when the producer set one. Records that aren't aggregates,
+    or whose checksum doesn't match, are passed on as they are.
+    """
+    out = []
+    for record in records:
+        if not is_aggregated(record['Data']):
+            out.append(record)
+            continue
+        try:
+            user_records = list(unpack(record['Data']))
+        except (ValueError, IndexError):
+            out.append(record)
+            continue
+        for sub, (partition_key, hash_key, data) in enumerate(user_records):
+            user_record = dict(record, PartitionKey=partition_key, Data=data, SubSequenceNumber=sub)
+            if hash_key is not None:
+                user_record['ExplicitHashKey'] = hash_key
+            out.append(user_record)
+    return out
+
+
+class Aggregator():
+    """
+    Packs user records into one aggregated record of at most about `max_bytes`
+    """
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.keys = {}
+        self.hash_keys = {}
+        self.records = []
+        self.size = len(MAGIC) + DIGEST_SIZE
+
+    def __len__(self):
+        return len(self.records)
+
+    def fits(self, partition_key, data, explicit_hash_key=None):
+        """
+        True when the record can be added without going over `max_bytes`. An empty
+        aggregate takes any record.
+        """
+        return not self.records or self.size + self._cost(partition_key, data, explicit_hash_key) <= self.max_bytes
+
+    def _cost(self, partition_key, data, explicit_hash_key):
+        # table entries, the record's own fields and its framing, a few bytes over at most
+        cost = len(data) + 16
+        if partition_key not in self.keys:
+            cost += len(partition_key.encode('utf-8')) + 4
+        if explicit_hash_key is not None and explicit_hash_key not in self.hash_keys:
+            cost += len(explicit_hash_key) + 4
+        return cost
+
+    def add(self, partition_key, data, explicit_hash_key=None):
+        self.size += self._cost(partition_key, data, explicit_hash_key)
+        record = _varint(1 << 3 | _VARINT) + _varint(self.keys.setdefault(partition_key, len(self.keys)))
+        if explicit_hash_key is not None:
+            index = self.hash_keys.setdefault(explicit_hash_key, len(self.hash_keys))
+            record += _varint(2 << 3 | _VARINT) + _varint(index)
+        self.records.append(record + _field(3, data))
+
+    def data(self):
+        """
+        The aggregated record's data
+        """
+        message = b''.join(
+            [_field(1, key) for key in self.keys]
+            + [_field(2, key) for key in self.hash_keys]
+            + [_field(3, record) for record in self.records]
+        )
+        return MAGIC + message + hashlib.md5(message).digest()
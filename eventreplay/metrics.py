@@ -0,0 +1,166 @@
+"""
+Per-stage latency and throughput metrics.
+
+Nothing is recorded until a sink is set with `set_sink`. Stages time themselves
+with `start` and `observe`, which do nothing but a None check when there is no sink:
+
+    started = metrics.start()
+    messages = queue.receive_messages(...)
+    metrics.observe('sqs.receive', started, len(messages))
+
+A sink has `observe(stage, seconds, count)`, called once per timed call with the
+number of messages it handled, and `incr(name, value)` for counters. `Registry`
+aggregates them into histograms that can be served in the Prometheus text format,
+`Callback` passes every event to a function.
+"""
+import time
+import bisect
+import threading
+
+
+# seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PREFIX = 'eventreplay'
+
+_sink = None
+
+
+def set_sink(sink):
+    """
+    Send metrics to `sink`, or stop recording with None
+    """
+    global _sink
+    _sink = sink
+
+
+def start():
+    """
+    Start time for `observe`, None when there is no sink
+    """
+    return time.perf_counter() if _sink else None
+
+
+def observe(stage, started, count=1):
+    """
+    Record a call to `stage` that began at `started`, handling `count` messages
+    """
+    if started is None or _sink is None:
+        return
+    _sink.observe(stage, time.perf_counter() - started, count)
+
+
+def incr(name, value=1):
+    if _sink:
+        _sink.incr(name, value)
+
+
+class Callback():
+    """
+    Pass every event to `fn(kind, name, value, count)`, kind is 'observe' or 'incr'
+    """
+    def __init__(self, fn):
+        self.fn = fn
+
+    def observe(self, stage, seconds, count):
+        self.fn('observe', stage, seconds, count)
+
+    def incr(self, name, value):
+        self.fn('incr', name, value, 1)
+
+
+class Histogram():
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.calls = 0
+        self.messages = 0
+        self.seconds = 0.0
+
+    def add(self, seconds, count):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.calls += 1
+        self.messages += count
+        self.seconds += seconds
+
+
+class Registry():
+    """
+    Histogram of call latency and message count per stage, plus counters
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds, count):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.add(seconds, count)
+
+    def incr(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Totals per stage and counter, eg for logging
+        """
+        with self.lock:
+            return {
+                'stages': {
+                    stage: {'calls': h.calls, 'messages': h.messages, 'seconds': h.seconds}
+                    for stage, h in self.stages.items()
+                },
+                'counters': dict(self.counters),
+            }
+
+    def prometheus(self):
+        """
+        Prometheus text exposition format
+        """
+        lines = [f'# TYPE {PREFIX}_stage_seconds histogram']
+        with self.lock:
+            stages = sorted(self.stages.items())
+            counters = sorted(self.counters.items())
+            for stage, h in stages:
+                total = 0
+                for bound, hits in zip(BUCKETS + ('+Inf',), h.buckets):
+                    total += hits
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {total}')
+                lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {h.seconds}')
+                lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {h.calls}')
+            lines.append(f'# TYPE {PREFIX}_stage_messages_total counter')
+            for stage, h in stages:
+                lines.append(f'{PREFIX}_stage_messages_total{{stage="{stage}"}} {h.messages}')
+            lines.append(f'# TYPE {PREFIX}_events_total counter')
+            for name, value in counters:
+                lines.append(f'{PREFIX}_events_total{{event="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def serve(registry, port, host='127.0.0.1'):
+    """
+    Serve the registry at http://host:port/metrics from a daemon thread, returns
+    the server so it can be shut down
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='eventreplay-metrics', daemon=True).start()
+    return server
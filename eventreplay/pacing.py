@@ -0,0 +1,101 @@
+"""
+Pace replayed messages to reproduce the original traffic shape.
+"""
+import time
+
+
+class TokenBucket():
+    """
+    Allow at most `rate` messages per second, with bursts of up to `capacity` once
+    the bucket has filled. It starts nearly empty so the first second isn't a burst.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = 1
+        self.updated = time.monotonic()
+
+    def wait(self, now):
+        """
+        Take a token, returns the seconds to wait before it may be used
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Pacer():
+    """
+    Release messages at their original inter-arrival gaps divided by `speed`, and
+    never faster than `rate` messages per second. Either may be None.
+
+    `timestamp` returns a message's original send time in seconds. Messages must
+    arrive in timestamp order for the gaps to mean anything.
+    """
+    def __init__(self, timestamp, speed=None, rate=None, group_size=10):
+        self.timestamp = timestamp
+        self.speed = speed
+        self.bucket = TokenBucket(rate, capacity=max(min(rate, group_size), 1)) if rate else None
+        self.group_size = group_size
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.started = None
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def groups(self, messages):
+        """
+        Yield lists of messages that are due together
+        """
+        group = []
+        for message in messages:
+            now = time.monotonic()
+            if self.started is None:
+                self.started = now
+            due = now
+            if self.speed:
+                ts = self.timestamp(message)
+                if self.first is None:
+                    self.first = ts
+                self.last = ts
+                due = self.started + (ts - self.first) / self.speed
+            if self.bucket:
+                due = max(due, now + self.bucket.wait(now))
+            if due > now:
+                if group:
+                    yield group
+                    group = []
+                time.sleep(max(due - time.monotonic(), 0))
+            lag = max(time.monotonic() - due, 0)
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            self.count += 1
+            group.append(message)
+            if len(group) >= self.group_size:
+                yield group
+                group = []
+        if group:
+            yield group
+
+    def target_rate(self):
+        """
+        Messages per second the schedule asked for
+        """
+        rates = []
+        if self.speed and self.count > 1 and self.last > self.first:
+            rates.append((self.count - 1) / ((self.last - self.first) / self.speed))
+        if self.bucket:
+            rates.append(self.bucket.rate)
+        return min(rates) if rates else None
+
+    def report(self, summary, elapsed):
+        """
+        Add rate and scheduling lag to a ReplaySummary
+        """
+        summary.elapsed = elapsed
+        summary.target_rate = self.target_rate()
+        summary.lag_mean = self.lag_total / self.count if self.count else 0.0
+        summary.lag_max = self.lag_max
+        return summary
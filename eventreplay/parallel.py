@@ -0,0 +1,111 @@
+"""
+Replay long time ranges on a pool of worker processes.
+"""
+import os
+import time
+import logging
+import multiprocessing
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from eventreplay import eventers, exceptions
+from eventreplay.eventers import base
+from eventreplay.storage.s3 import parse_time
+
+TASKS_PER_WORKER = 4 # shards per worker, so workers that finish early pick up more
+UNITS = {'minute': timedelta(minutes=1), 'hour': timedelta(hours=1)}
+MINUTE_FORMAT = '%Y/%m/%d/%H/%M'
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+_replayer = None # built once in each worker process
+
+
+def shards(start, end, count, unit=None):
+    """
+    Split start to end into at most `count` contiguous (start, end) ranges on
+    `unit` boundaries, 'minute' or 'hour'. By default hours are used when there
+    are at least `count` of them. Ends are inclusive to the minute, as for Reader.
+    """
+    first, _ = parse_time(start)
+    last, _ = parse_time(end)
+    first = first.replace(second=0, microsecond=0)
+    last = last.replace(second=0, microsecond=0)
+    if last < first:
+        raise exceptions.EventerException(f'end is before start: {start} - {end}')
+    if unit is None:
+        unit = 'hour' if last - first >= count * UNITS['hour'] else 'minute'
+    if unit not in UNITS:
+        raise exceptions.EventerException(f'unsupported shard unit: {unit}')
+    step = UNITS[unit]
+    # boundaries on whole units between start and end
+    boundaries = []
+    ts = first.replace(minute=0) + step if unit == 'hour' else first + step
+    while ts <= last:
+        boundaries.append(ts)
+        ts += step
+    per_shard = -(-(len(boundaries) + 1) // count) # ceil
+    boundaries = boundaries[per_shard - 1::per_shard]
+    ranges, shard_start = [], start
+    for boundary in boundaries:
+        ranges.append((shard_start, (boundary - UNITS['minute']).strftime(MINUTE_FORMAT)))
+        shard_start = boundary.strftime(MINUTE_FORMAT)
+    ranges.append((shard_start, end))
+    return ranges
+
+
+def _start_worker(eventer, params):
+    global _replayer
+    _replayer = eventers.client(eventer, action='replay', **params)
+
+
+def _replay_shard(start, end, bucket, where):
+    return _replayer.replay(start, end, bucket, where=where)
+
+
+def replay(eventer, start, end, bucket, workers=os.cpu_count(), unit=None, where=None, progress=None, **params):
+    """
+    Replay start to end with `workers` processes, each with its own reader and
+    publisher. `params` are passed to the eventer's replayer, eg queue or
+    stream_name. The range is split into shards of whole minutes or hours, see
+    `shards`, so messages keep their order within a shard but not across shards.
+
+    `progress(done, total, summary)` is called in this process as shards finish,
+    with the running totals. Returns the combined ReplaySummary.
+    """
+    if params.get('speed') and workers > 1:
+        raise exceptions.EventerException('speed keeps the gaps between messages, it needs a single worker')
+    if params.get('rate'):
+        # the cap is for the whole replay
+        params = dict(params, rate=params['rate'] / workers)
+    ranges = shards(start, end, workers * TASKS_PER_WORKER, unit)
+    logger.info('replaying %s to %s in %d shards on %d workers', start, end, len(ranges), workers)
+    summary = base.ReplaySummary()
+    lag_total = 0.0
+    started = time.monotonic()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_start_worker, initargs=(eventer, params)) as pool:
+        futures = {pool.submit(_replay_shard, shard_start, shard_end, bucket, where): (shard_start, shard_end)
+                   for shard_start, shard_end in ranges}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                summary.add(result)
+                lag_total += result.lag_mean * result.sent
+                summary.lag_max = max(summary.lag_max, result.lag_max)
+                summary.elapsed = time.monotonic() - started
+                logger.info('shard %s - %s done (%d/%d): sent: %d; failed: %d; total sent: %d; %.1f/s',
+                            *futures[future], done, len(ranges), result.sent, result.failed,
+                            summary.sent, summary.achieved_rate or 0)
+                if progress:
+                    progress(done, len(ranges), summary)
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    summary.elapsed = time.monotonic() - started
+    summary.lag_mean = lag_total / summary.sent if summary.sent else 0.0
+    if params.get('rate'):
+        summary.target_rate = params['rate'] * workers
+    return summary
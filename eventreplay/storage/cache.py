@@ -0,0 +1,149 @@
+"""
+Local disk cache of fetched objects, so replaying the same window again reads
+local files instead of S3.
+"""
+import os
+import mmap
+import hashlib
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+
+from eventreplay import metrics
+
+
+CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+_caches = {}
+_lock = threading.Lock()
+
+
+class DiskCache():
+    """
+    Objects under `directory`, keyed by bucket, key, ETag and byte range. Once
+    they take more than `max_bytes` the least recently used are evicted. A
+    rewritten object gets a new ETag, so entries never go stale and old ones age out.
+
+    Cached objects are read through memory maps. Recency is kept in file mtimes so
+    it survives restarts. Processes sharing a directory each evict by their own
+    view of it, so together they may briefly go over `max_bytes`.
+    """
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # file name -> size, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        with self.lock:
+            for _, name, size in sorted(found):
+                self.entries[name] = size
+                self.size += size
+            self._evict()
+
+    @staticmethod
+    def _name(bucket, key, etag, byte_range=None):
+        return hashlib.sha256(f'{bucket}\0{key}\0{etag}\0{byte_range or ""}'.encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def open(self, bucket, key, etag, byte_range=None):
+        """
+        Read-only memory map of a cached object, None when it isn't cached. The
+        map is closed on leaving the block, copy out what you need.
+        """
+        name = self._name(bucket, key, etag, byte_range)
+        path = os.path.join(self.directory, name)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+                # evicted by another process
+                self.size -= self.entries.pop(name, 0)
+            metrics.incr('s3.cache_misses')
+            yield None
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            with self.lock:
+                self.hits += 1
+                if name not in self.entries:
+                    # written by another process
+                    self.size += size
+                self.entries[name] = size
+                self.entries.move_to_end(name)
+            metrics.incr('s3.cache_hits')
+            os.utime(f.fileno())
+            if not size:
+                yield b''
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+    def put(self, bucket, key, etag, data, byte_range=None):
+        """
+        Cache an object, evicting others to stay under `max_bytes`
+        """
+        if len(data) > self.max_bytes:
+            return
+        name = self._name(bucket, key, etag, byte_range)
+        path = os.path.join(self.directory, name)
+        # write then rename so readers never see a partial file
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            # a full or read-only disk only costs the cache
+            self.logger.warning('Error caching %s: %s', key, e)
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            return
+        with self.lock:
+            self.size += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            metrics.incr('s3.cache_evictions')
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(self.directory, name))
+
+    def stats(self):
+        """
+        Hit, miss and eviction counts since this process opened the cache, and its size
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'bytes': self.size, 'objects': len(self.entries)}
+
+
+def get(directory, max_bytes=CACHE_MAX_BYTES):
+    """
+    Cache for a directory, shared by every reader in the process. The first
+    caller's `max_bytes` applies.
+    """
+    directory = os.path.abspath(directory)
+    with _lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = DiskCache(directory, max_bytes)
+        return cache
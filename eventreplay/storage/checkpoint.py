@@ -0,0 +1,140 @@
+"""
+Checkpoint stream positions so consumers resume where they left off.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+from botocore.exceptions import ClientError
+
+from eventreplay import clients, exceptions
+
+
+CHECKPOINT_PREFIX = '_checkpoints'
+CHECKPOINT_INTERVAL = 10 # seconds between flushes
+CHECKPOINT_EVERY = 1000 # records between flushes
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+
+
+class MemoryStore():
+    """
+    Keeps checkpoints for the life of the process only
+    """
+    def __init__(self):
+        self.checkpoints = {}
+
+    def load(self):
+        return dict(self.checkpoints)
+
+    def save(self, checkpoints):
+        self.checkpoints = dict(checkpoints)
+
+
+class FileStore():
+    """
+    Checkpoints in a local json file, eg on a mounted EFS volume
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save(self, checkpoints):
+        # write then rename so a crash never leaves a partial file
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(checkpoints, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+class S3Store():
+    """
+    Checkpoints in a json object
+    """
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.client = clients.client('s3')
+
+    def load(self):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return {}
+            raise
+        return json.loads(response['Body'].read())
+
+    def save(self, checkpoints):
+        body = json.dumps(checkpoints).encode('utf-8')
+        self.client.put_object(Body=body, Bucket=self.bucket, Key=self.key)
+
+
+def store(kind, destination, name):
+    """
+    Build a store - `destination` is a file path for 'file' and a bucket for 's3'
+    """
+    if kind in ('file', 's3') and not destination:
+        raise exceptions.EventerException(f'checkpoint store {kind} needs a checkpoint_destination')
+    match kind:
+        case None | 'memory':
+            return MemoryStore()
+        case 'file':
+            return FileStore(destination)
+        case 's3':
+            return S3Store(destination, f'{CHECKPOINT_PREFIX}/{name}.json')
+        case _:
+            raise exceptions.EventerException(f'checkpoint store not implemented: {kind}')
+
+
+class Checkpointer():
+    """
+    Coalesce checkpoint updates and save them every `interval` seconds or every
+    `every` updates, whichever comes first.
+    """
+    def __init__(self, store, interval=CHECKPOINT_INTERVAL, every=CHECKPOINT_EVERY):
+        self.store = store
+        self.interval = interval
+        self.every = every
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.checkpoints = store.load()
+        self.pending = 0
+        self.flushed = time.monotonic()
+
+    def get(self, key):
+        with self.lock:
+            return self.checkpoints.get(key)
+
+    def update(self, key, position, count=1):
+        with self.lock:
+            self.checkpoints[key] = position
+            self.pending += count
+            due = self.pending >= self.every or time.monotonic() - self.flushed >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            checkpoints = dict(self.checkpoints)
+            self.pending = 0
+            self.flushed = time.monotonic()
+        try:
+            self.store.save(checkpoints)
+        except Exception as e:
+            # positions stay in memory and are saved with the next flush
+            self.logger.error('Error saving checkpoints: %s', e)
+            with self.lock:
+                self.pending += 1
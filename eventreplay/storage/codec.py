@@ -0,0 +1,152 @@
+"""
+Encode stored messages. Every format is tagged by its first byte so objects
+written by older versions still decode:
+
+    {  json object, the original format
+    [  compact json array of a fixed field set, [version, *values]
+    \\x00 binary, followed by a version byte and one length-prefixed blob per field
+"""
+import json
+import struct
+
+from eventreplay import exceptions
+
+
+JSON_VERSION = 1
+BINARY_TAG = b'\x00'
+BINARY_VERSION = 1
+
+_LENGTH = struct.Struct('>I')
+_NONE = 0xFFFFFFFF
+_DUMPS = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+_LOADS = json.loads
+
+
+def as_dict(content):
+    """
+    Plain dict for a message object, a dict is returned as is
+    """
+    if isinstance(content, dict):
+        return content
+    if hasattr(content, 'to_dict'):
+        return content.to_dict()
+    return content.__dict__
+
+
+class DictCodec():
+    """
+    Compact json object with whatever fields the content has
+    """
+    name = 'dict'
+    framed = False
+
+    def encode(self, content):
+        return _DUMPS(as_dict(content)).encode('utf-8')
+
+    def decode(self, data):
+        return decode(data)
+
+
+class JSONCodec():
+    """
+    Compact json array of the values of `fields`
+    """
+    name = 'json'
+    framed = False
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def encode(self, content):
+        record = as_dict(content)
+        return _DUMPS([JSON_VERSION, *(record.get(field) for field in self.fields)]).encode('utf-8')
+
+    def decode(self, data):
+        return decode(data, self.fields)
+
+
+class BinaryCodec():
+    """
+    Length-prefixed fields. Strings are stored as utf-8 so bodies aren't escaped,
+    anything else as compact json. Output may contain newlines, so segments of
+    binary messages are length-prefixed rather than newline-delimited.
+    """
+    name = 'binary'
+    framed = True
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.header = BINARY_TAG + bytes([BINARY_VERSION])
+
+    def encode(self, content):
+        record = as_dict(content)
+        parts = [self.header]
+        for field in self.fields:
+            value = record.get(field)
+            if value is None:
+                parts.append(_LENGTH.pack(_NONE))
+                continue
+            if isinstance(value, str):
+                blob = b's' + value.encode('utf-8')
+            else:
+                blob = b'j' + _DUMPS(value).encode('utf-8')
+            parts.append(_LENGTH.pack(len(blob)))
+            parts.append(blob)
+        return b''.join(parts)
+
+    def decode(self, data):
+        return decode(data, self.fields)
+
+
+def _decode_binary(data, fields):
+    if data[1] != BINARY_VERSION:
+        raise exceptions.EventerException(f'unsupported binary message version: {data[1]}')
+    record = {}
+    unpack = _LENGTH.unpack_from
+    pos = 2
+    for field in fields:
+        (length,) = unpack(data, pos)
+        pos += 4
+        if length == _NONE:
+            record[field] = None
+            continue
+        end = pos + length
+        if data[pos] == 0x73: # b's'
+            record[field] = data[pos + 1:end].decode('utf-8')
+        else:
+            record[field] = _LOADS(data[pos + 1:end])
+        pos = end
+    return record
+
+
+def decode(data, fields=None):
+    """
+    Decode a message in any of the tagged formats. `fields` is required for the
+    compact json and binary formats.
+    """
+    first = data[:1]
+    if first == b'{':
+        return _LOADS(data)
+    if first == b'[':
+        values = _LOADS(data)
+        if values[0] != JSON_VERSION:
+            raise exceptions.EventerException(f'unsupported json message version: {values[0]}')
+        return dict(zip(fields, values[1:]))
+    if first == BINARY_TAG:
+        return _decode_binary(data, fields)
+    raise exceptions.EventerException('unknown message format')
+
+
+def get(name, fields=None):
+    """
+    Build a codec by name
+    """
+    match name:
+        case None | 'dict':
+            return DictCodec()
+        case 'json':
+            return JSONCodec(fields)
+        case 'binary':
+            return BinaryCodec(fields)
+        case _:
+            raise exceptions.EventerException(f'codec not implemented: {name}')
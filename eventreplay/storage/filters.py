@@ -0,0 +1,185 @@
+"""
+Filter stored messages by field value, and summarize the values written to each
+object so readers can skip objects that cannot match.
+
+Fields are dotted paths into a stored message, eg `attributes.SentTimestamp`,
+`message_attributes.tenant` or `body.order.type`. A string field followed by more
+path is parsed as a json document, or as base64 encoded json for Kinesis data.
+"""
+import math
+import json
+import base64
+import hashlib
+import binascii
+
+from eventreplay import exceptions
+from eventreplay.storage import codec
+
+
+SUMMARY_MAX_VALUES = 64 # distinct values kept as a set, beyond that a bloom filter
+BLOOM_ERROR_RATE = 0.01
+
+
+def _document(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        pass
+    try:
+        return json.loads(base64.b64decode(value, validate=True))
+    except (ValueError, binascii.Error):
+        return None
+
+
+def resolve(record, path, documents=None):
+    """
+    Value at a dotted path of a message dict, None when it isn't there. Pass the
+    same `documents` dict when resolving several paths of one message so each json
+    string in it is parsed only once.
+    """
+    value = record
+    for name in path.split('.'):
+        if isinstance(value, str):
+            if documents is None:
+                value = _document(value)
+            else:
+                # strings of a message stay alive while it's resolved, so ids are unique
+                if id(value) not in documents:
+                    documents[id(value)] = _document(value)
+                value = documents[id(value)]
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    # sqs message attributes are stored as {'StringValue': ..., 'DataType': ...}
+    if isinstance(value, dict) and 'DataType' in value:
+        value = value.get('StringValue', value.get('BinaryValue'))
+    return value
+
+
+def token(value):
+    """
+    Comparable string for a field value, strings as is and anything else as json
+    """
+    if isinstance(value, str):
+        return value
+    if type(value) is int:
+        return str(value)
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+class Bloom():
+    """
+    Bloom filter over strings, sized for `count` values at `error_rate`
+    """
+    def __init__(self, count=0, bits=None, hashes=None, error_rate=BLOOM_ERROR_RATE):
+        if bits is None:
+            size = max(int(-count * math.log(error_rate) / math.log(2) ** 2), 8)
+            bits = bytearray((size + 7) // 8)
+            hashes = max(round(size / max(count, 1) * math.log(2)), 1)
+        self.bits = bits
+        self.hashes = hashes
+        self.size = len(bits) * 8
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big')
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos // 8] |= 1 << pos % 8
+
+    def __contains__(self, value):
+        return all(self.bits[pos // 8] & 1 << pos % 8 for pos in self._positions(value))
+
+    def to_dict(self):
+        return {'bloom': base64.b64encode(self.bits).decode('ascii'), 'hashes': self.hashes}
+
+    @classmethod
+    def from_dict(cls, summary):
+        return cls(bits=bytearray(base64.b64decode(summary['bloom'])), hashes=summary['hashes'])
+
+
+class Summary():
+    """
+    Values seen for each of `fields` across the messages of one object
+    """
+    def __init__(self, fields):
+        self.fields = fields
+        self.values = {field: set() for field in fields}
+
+    def add(self, content):
+        record = codec.as_dict(content)
+        for field in self.fields:
+            value = resolve(record, field)
+            if value is not None:
+                self.values[field].add(token(value))
+
+    def to_dict(self):
+        summary = {}
+        for field, values in self.values.items():
+            if len(values) <= SUMMARY_MAX_VALUES:
+                summary[field] = {'values': sorted(values)}
+                continue
+            bloom = Bloom(len(values))
+            for value in values:
+                bloom.add(value)
+            summary[field] = bloom.to_dict()
+        return summary
+
+
+class Filter():
+    """
+    Match messages whose fields have the given values, eg
+
+        Filter({'message_attributes.tenant': 'acme', 'body.type': ['created', 'updated']}, fields)
+
+    A list, tuple or set matches any of its values, and every field must match.
+    `fields` are the field names of the compact codecs, see storage.codec.
+    """
+    def __init__(self, where, fields=None):
+        if not where:
+            raise exceptions.EventerException('filter needs at least one field')
+        self.fields = fields
+        self.where = {
+            path: {token(v) for v in value} if isinstance(value, (list, tuple, set, frozenset)) else {token(value)}
+            for path, value in where.items()
+        }
+
+    def matches(self, record):
+        """
+        True when a message dict matches
+        """
+        documents = {}
+        for path, values in self.where.items():
+            value = resolve(record, path, documents)
+            if value is None or token(value) not in values:
+                return False
+        return True
+
+    def matches_data(self, data):
+        """
+        True when a stored message matches
+        """
+        return self.matches(codec.decode(data, self.fields))
+
+    def may_match(self, summary):
+        """
+        False only when an object's summary rules out every message in it. Fields the
+        summary doesn't cover could hold anything. An empty value set means no message
+        in the object has the field, so nothing in it can match.
+        """
+        if not summary:
+            return True
+        for path, values in self.where.items():
+            entry = summary.get(path)
+            if entry is None:
+                continue
+            if 'values' in entry:
+                if values.isdisjoint(entry['values']):
+                    return False
+            else:
+                bloom = Bloom.from_dict(entry)
+                if not any(value in bloom for value in values):
+                    return False
+        return True
@@ -0,0 +1,120 @@
+"""
+Record replay progress so an interrupted replay can resume where it stopped.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+from collections import deque
+
+from eventreplay import exceptions
+
+
+JOURNAL_VERSION = 1
+JOURNAL_EVERY = 100 # finished objects between flushes
+JOURNAL_INTERVAL = 5 # seconds between flushes
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+
+
+class Journal():
+    """
+    Progress of one replay in a local json file, one file per replay under
+    `directory`. A replay is identified by `job`, eg its bucket, range and target.
+
+    Objects are read in key order and their messages numbered as they are read.
+    `ack` marks a run of messages as sent, or failed for good. Once every message
+    of an object and of all objects before it is acknowledged, that object is
+    finished, and the last finished key is what a resumed replay continues after.
+    Objects read but not finished when the replay stopped are sent again.
+    """
+    def __init__(self, directory, job, every=JOURNAL_EVERY, interval=JOURNAL_INTERVAL):
+        self.job = job
+        digest = hashlib.sha1(json.dumps(job, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(directory, f'replay-{digest}.json')
+        self.every = every
+        self.interval = interval
+        self.logger = logging.getLogger(__name__)
+        self.last = None # last finished key
+        self.complete = False
+        self.sent = 0
+        self.failed = 0
+        self.count = 0 # messages read so far
+        self.acked = 0 # messages acknowledged in order, every message before this one is done
+        self.ranges = {} # start -> end of runs acknowledged out of order
+        self.ends = deque() # (message count at the end of an object, key), in read order
+        self.pending = 0
+        self.flushed = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """
+        Pick up the progress of an earlier run of the same replay
+        """
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        if state.get('version') != JOURNAL_VERSION or state.get('job') != json.loads(json.dumps(self.job, default=str)):
+            raise exceptions.EventerReplayerException(f'journal {self.path} is for a different replay')
+        self.last = state['last']
+        self.complete = state['complete']
+        self.sent = state['sent']
+        self.failed = state['failed']
+        self.logger.info('resuming replay after %s, %d messages sent before', self.last, self.sent)
+
+    def tracked(self, objects):
+        """
+        Messages of (key, messages) pairs, recording where each object ends
+        """
+        for key, messages in objects:
+            yield from messages
+            self.count += len(messages)
+            self.ends.append((self.count, key))
+
+    def ack(self, start, end, summary):
+        """
+        Messages start to end have been handled, with `summary` as the outcome
+        """
+        self.sent += summary.sent
+        self.failed += summary.failed
+        self.ranges[start] = end
+        while self.acked in self.ranges:
+            self.acked = self.ranges.pop(self.acked)
+        self._advance()
+
+    def _advance(self):
+        while self.ends and self.ends[0][0] <= self.acked:
+            _, self.last = self.ends.popleft()
+            self.pending += 1
+        if self.pending >= self.every or (self.pending and time.monotonic() - self.flushed >= self.interval):
+            self.flush()
+
+    def finish(self):
+        """
+        Every message has been handled
+        """
+        self._advance()
+        self.complete = True
+        self.flush()
+
+    def flush(self):
+        state = {
+            'version': JOURNAL_VERSION,
+            'job': self.job,
+            'last': self.last,
+            'complete': self.complete,
+            'sent': self.sent,
+            'failed': self.failed,
+        }
+        # write then rename so a crash never leaves a partial file
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.pending = 0
+        self.flushed = time.monotonic()
@@ -3,27 +3,78 @@ Handle reading of messages saved in S3.
 """
 import os
 import re
+import gzip
 import json
+import time
+import uuid
+import zlib
+import struct
 import logging
-from datetime import datetime, timezone
-from dataclasses import dataclass
+import itertools
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-import boto3
+from botocore.exceptions import ClientError
 
-from eventreplay import exceptions
+from eventreplay import clients, exceptions, metrics
+from eventreplay.storage import codec, filters
+from eventreplay.storage import cache as read_cache
 
 
 PATTERN = r"(\d{4}/\d{2}/\d{2}/\d{2}/\d{2})"
 
+# segment objects hold many messages for one minute partition, either newline-delimited
+# or, for codecs whose output may contain newlines, prefixed with their length
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_EXTENSION = '.jsonl'
+FRAMED_SEGMENT_EXTENSION = '.bin'
+FRAME_LENGTH = struct.Struct('>I')
+COMPRESSIONS = {None: '', 'gzip': '.gz'}
+
+SEGMENT_MAX_BYTES = 8 * 1024 * 1024
+SEGMENT_MAX_COUNT = 10000
+SEGMENT_MAX_AGE = 60 # seconds
+
+# segments are written in independently compressed blocks of about this many bytes, and
+# a sidecar index maps each block's time range to its byte range for ranged reads
+SEGMENT_BLOCK_BYTES = 64 * 1024
+INDEX_EXTENSION = '.idx'
+INDEX_VERSION = 1
+
+# replay ranges may be given to the minute, second or millisecond - (format, precision in ms)
+TIME_FORMATS = (
+    ('%Y/%m/%d/%H/%M', 60000),
+    ('%Y/%m/%d/%H/%M/%S', 1000),
+    ('%Y/%m/%d/%H/%M/%S.%f', 1),
+)
+
+READ_CONCURRENCY = 8
+READ_PREFETCH = 32 # objects held in memory ahead of the caller
+
+# per-hour index of the objects written, kept apart from the message partitions
+MANIFEST_PREFIX = '_manifests'
+MANIFEST_VERSION = 1
+MANIFEST_RETRIES = 5
+MANIFEST_INTERVAL = 30 # seconds between manifest merges, entries are coalesced in between
+
+# which key layouts an eventer's objects use, 0 is unsharded, n is n hash shards per partition
+LAYOUT_PREFIX = '_layout'
+LAYOUT_VERSION = 1
+MAX_SHARDS = 256 # shards are named with two hex digits
+LAYOUT_RETRY_INTERVAL = 300 # seconds between registration attempts of an unsharded writer that failed
+
 logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 
-S3_CLIENT = boto3.client('s3', region_name='us-west-2')
+DEFAULT_CODEC = codec.DictCodec()
 
 @dataclass
 class File():
     name: str
     timestamp: str
     content: dict
+    time: int = None # epoch ms, needed to index segments
 
 @dataclass
 class Packet():
@@ -31,93 +82,711 @@ class Packet():
     prefix: str
     files: list
 
+@dataclass
+class Segment():
+    """
+    Encoded messages buffered for a single minute partition
+    """
+    timestamp: str
+    lines: list = field(default_factory=list)
+    times: list = field(default_factory=list)
+    size: int = 0
+    created: float = field(default_factory=time.monotonic)
+    framed: bool = False
+    summary: filters.Summary = None
+
+    def append(self, line, time=None):
+        self.lines.append(line)
+        self.times.append(time)
+        self.size += len(line) + (FRAME_LENGTH.size if self.framed else 1)
+
+    def _join(self, lines):
+        if self.framed:
+            return b''.join(FRAME_LENGTH.pack(len(line)) + line for line in lines)
+        return b'\n'.join(lines) + b'\n'
+
+    def body(self, compression=None):
+        """
+        Encoded segment and its index. When every line has a time the lines are
+        sorted by time and the index lists [first time, last time, start, end] for
+        each block. Blocks are compressed separately, so any run of blocks can be
+        fetched with a ranged GET and decompressed on its own.
+        """
+        lines, times = self.lines, self.times
+        indexed = None not in times
+        if indexed:
+            order = sorted(range(len(lines)), key=times.__getitem__)
+            lines = [lines[i] for i in order]
+            times = [times[i] for i in order]
+        parts, blocks, offset, first, size = [], [], 0, 0, 0
+        for ind, line in enumerate(lines):
+            size += len(line)
+            if size < SEGMENT_BLOCK_BYTES and ind < len(lines) - 1:
+                continue
+            data = self._join(lines[first:ind + 1])
+            if compression == 'gzip':
+                data = gzip.compress(data)
+            blocks.append([times[first], times[ind], offset, offset + len(data)])
+            parts.append(data)
+            offset += len(data)
+            first, size = ind + 1, 0
+        index = {'version': INDEX_VERSION, 'blocks': blocks} if indexed else None
+        return b''.join(parts), index
+
+
+def is_segment(key):
+    """
+    True when the object holds a segment rather than a single message
+    """
+    name = key.rpartition('/')[2]
+    if not name.startswith(SEGMENT_PREFIX) or name.endswith(INDEX_EXTENSION):
+        return False
+    return SEGMENT_EXTENSION in name or FRAMED_SEGMENT_EXTENSION in name
+
+
+def manifest_key(eventer, hour):
+    """
+    Key of the manifest for an hour partition, eg _manifests/sqs/2024/10/15/17.json
+    """
+    return f'{MANIFEST_PREFIX}/{eventer}/{hour}.json'
+
+
+def layout_key(eventer):
+    """
+    Key of an eventer's layout descriptor, eg _layout/sqs.json
+    """
+    return f'{LAYOUT_PREFIX}/{eventer}.json'
+
+
+def shard_of(name, shards):
+    """
+    Hash shard of an object name, eg '0a'
+    """
+    return f'{zlib.crc32(name.encode("utf-8")) % shards:02x}'
+
+
+def key_order(key):
+    """
+    Sort key putting objects in time order whatever their shard
+    """
+    match = re.search(PATTERN, key)
+    return (match.group(0) if match else '', key)
+
+
+def parse_time(dt):
+    """
+    datetime and precision in ms of a time string in any of TIME_FORMATS
+    """
+    for fmt, precision in TIME_FORMATS:
+        try:
+            return datetime.strptime(dt, fmt).replace(tzinfo=timezone.utc), precision
+        except (TypeError, ValueError):
+            # TypeError for anything but a string, eg 202410150800
+            continue
+    raise exceptions.EventerException(f'invalid time, expected yyyy/mm/dd/hh/mm[/ss[.fff]]: {dt}')
+
+
+def split_segment(key, data):
+    """
+    Decode a segment object into individual message payloads
+    """
+    if key.endswith(COMPRESSIONS['gzip']):
+        data = gzip.decompress(data)
+    if FRAMED_SEGMENT_EXTENSION not in key.rpartition('/')[2]:
+        # no copy for bytes, a cached object's memory map is copied once
+        return [line for line in bytes(data).split(b'\n') if line]
+    messages, pos = [], 0
+    while pos < len(data):
+        (length,) = FRAME_LENGTH.unpack_from(data, pos)
+        pos += FRAME_LENGTH.size
+        messages.append(data[pos:pos + length])
+        pos += length
+    return messages
+
 
 class Writer():
-    def __init__(self, eventer, bucket):
+    """
+    Buffer messages by minute partition and save them to S3.
+
+    By default every message is saved to its own object. With `segment=True` the
+    messages for a partition are rolled into one newline-delimited object which is
+    flushed once it reaches `max_bytes`, `max_count` or `max_age` seconds.
+
+    Messages are encoded with `codec`, see storage.codec. The default writes each
+    message as a compact json object.
+
+    With `manifest=True` the keys, message counts and byte sizes written to each hour
+    are merged into that hour's manifest object so readers can skip listing. The
+    values of the `summarize` fields, eg ['message_attributes.tenant', 'body.type'],
+    are recorded for each object too, so filtered reads can skip objects that cannot
+    match. See storage.filters. Entries are merged every `manifest_interval` seconds
+    and on flush, each merge rewrites the whole hour's manifest.
+
+    With `shards` set, objects are spread over that many hash-named prefixes per
+    partition, eg sqs/0a/2024/10/15/17/08/<name>, so bursts don't hit the S3
+    request rate limit of a single prefix. The layouts in use are recorded in the
+    bucket's layout descriptor, see `layout_key`, before anything is written.
+    """
+    def __init__(self, eventer, bucket, segment=False, compression=None,
+                 max_bytes=SEGMENT_MAX_BYTES, max_count=SEGMENT_MAX_COUNT, max_age=SEGMENT_MAX_AGE,
+                 manifest=False, codec=None, summarize=None, shards=None, manifest_interval=MANIFEST_INTERVAL):
+        if compression not in COMPRESSIONS:
+            raise exceptions.EventerException(f'unsupported compression: {compression}')
+        if shards and not 1 < shards <= MAX_SHARDS:
+            raise exceptions.EventerException(f'shards must be between 2 and {MAX_SHARDS}: {shards}')
+        if summarize and not manifest:
+            raise exceptions.EventerException('summarize needs manifest=True, summaries are kept in the manifests')
         self.eventer = eventer
         self.bucket = bucket
         # self.packets = typing.Dict[str, File] # TODO: get typing working here
         self.packets = {}
-        self.client = S3_CLIENT
+        self.segments = {}
+        self.segment = segment
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.max_age = max_age
+        self.manifest = manifest
+        self.manifests = {}
+        self.manifest_interval = manifest_interval
+        self.manifest_partitions = {} # hour -> partitions with entries not merged yet
+        self.manifest_merged = time.monotonic()
+        self.summarize = summarize
+        self.codec = codec or DEFAULT_CODEC
+        self.shards = shards or 0
+        self.layout_registered = False
+        self.layout_retry = None # monotonic time of the next attempt after a failed unsharded registration
+        self.client = clients.client('s3')
         self.logger = logging.getLogger(__name__)
     
     def write(self):
-        """docstring"""
-        for ts, files in self.packets.items():
+        """
+        Write buffered files. Files that fail stay buffered for the next write.
+        """
+        if not self._register_layout():
+            return
+        if self.segment:
+            self._write_segments()
+            self._write_manifests()
+            return
+        packets, self.packets = self.packets, {}
+        for ts, files in packets.items():
             prefix = f'{self.eventer}/{ts}'
             for file in files:
                 try:
-                    body = json.dumps(file.content, default=lambda o: o.__dict__, indent=2).encode('utf-8')
-                    print('body:', body)
-                    key = f'{prefix}/{file.name}'
-                    self.client.put_object(Body=body, Bucket=self.bucket, Key=key)
+                    body = self.codec.encode(file.content)
+                    key = self._key(ts, file.name)
+                    started = metrics.start()
+                    response = self.client.put_object(Body=body, Bucket=self.bucket, Key=key)
+                    metrics.observe('s3.put', started)
+                    self._record(ts, key, 1, len(body), summary=self._summary(file.content), etag=response.get('ETag'))
                 except Exception as e:
+                    self._count_error(e)
                     self.logger.error('Error saving to s3: %s ', e)
+                    self.buffer(file)
             self.logger.info('writing files to: s3://%s/%s/ ', self.bucket, prefix)
+        self._write_manifests()
+
+    def flush(self):
+        """
+        Write every buffered segment and manifest entry regardless of thresholds
+        """
+        if self._register_layout():
+            if self.segment:
+                self._write_segments(force=True)
+            self._write_manifests(force=True)
+
+    def pending(self):
+        """
+        Timestamps of partitions with data, or manifest entries, that haven't been
+        written yet
+        """
+        pending = set(self.packets) | set(self.segments)
+        for partitions in self.manifest_partitions.values():
+            pending |= partitions
+        return pending
+
+    def _write_segments(self, force=False):
+        now = time.monotonic()
+        for ts in list(self.segments):
+            segment = self.segments[ts]
+            full = segment.size >= self.max_bytes or len(segment.lines) >= self.max_count
+            if force or full or now - segment.created >= self.max_age:
+                if self._put_segment(segment):
+                    del self.segments[ts]
+
+    def _key(self, ts, name):
+        if self.shards:
+            return f'{self.eventer}/{shard_of(name, self.shards)}/{ts}/{name}'
+        return f'{self.eventer}/{ts}/{name}'
+
+    @staticmethod
+    def _count_error(e):
+        metrics.incr('s3.put_errors')
+        if isinstance(e, ClientError) and e.response['Error']['Code'] in ('SlowDown', '503'):
+            metrics.incr('s3.slow_down')
+
+    def _put_segment(self, segment):
+        if not self._register_layout():
+            return False
+        extension = FRAMED_SEGMENT_EXTENSION if segment.framed else SEGMENT_EXTENSION
+        name = f'{SEGMENT_PREFIX}{uuid.uuid4().hex}{extension}{COMPRESSIONS[self.compression]}'
+        key = self._key(segment.timestamp, name)
+        try:
+            started = metrics.start()
+            body, index = segment.body(self.compression)
+            metrics.observe('s3.encode_segment', started, len(segment.lines))
+            started = metrics.start()
+            response = self.client.put_object(Body=body, Bucket=self.bucket, Key=key)
+            metrics.observe('s3.put', started, len(segment.lines))
+            self.logger.info('wrote segment of %d messages to: s3://%s/%s', len(segment.lines), self.bucket, key)
+        except Exception as e:
+            # segment stays buffered and is retried on the next write
+            self._count_error(e)
+            self.logger.error('Error saving segment to s3: %s ', e)
+            return False
+        if index:
+            try:
+                self.client.put_object(Body=json.dumps(index).encode('utf-8'), Bucket=self.bucket, Key=key + INDEX_EXTENSION)
+            except Exception as e:
+                # readers fall back to fetching the whole segment
+                self.logger.error('Error saving segment index to s3: %s ', e)
+                index = None
+        self._record(segment.timestamp, key, len(segment.lines), len(body), index=index is not None,
+                     summary=segment.summary, etag=response.get('ETag'))
+        return True
+
+    def _summary(self, content=None):
+        if not self.summarize:
+            return None
+        summary = filters.Summary(self.summarize)
+        if content is not None:
+            summary.add(content)
+        return summary
+
+    def _record(self, ts, key, count, size, index=False, summary=None, etag=None):
+        if self.manifest:
+            hour = ts.rpartition('/')[0]
+            entry = {'count': count, 'size': size}
+            if etag:
+                entry['etag'] = etag
+            if index:
+                entry['index'] = True
+            if summary:
+                entry['summary'] = summary.to_dict()
+            self.manifests.setdefault(hour, {})[key] = entry
+            self.manifest_partitions.setdefault(hour, set()).add(ts)
+
+    def _write_manifests(self, force=False):
+        if not force and time.monotonic() - self.manifest_merged < self.manifest_interval:
+            return
+        self.manifest_merged = time.monotonic()
+        for hour in list(self.manifests):
+            started = metrics.start()
+            if self._merge_manifest(hour, self.manifests[hour]):
+                metrics.observe('s3.manifest', started, len(self.manifests[hour]))
+                del self.manifests[hour]
+                del self.manifest_partitions[hour]
+            else:
+                metrics.incr('s3.manifest_errors')
+
+    def _merge_manifest(self, hour, objects):
+        """
+        Read-merge-write the hour's manifest. Conditional puts keep concurrent
+        writers from overwriting each other's entries.
+        """
+        def merge(manifest):
+            manifest['objects'].update(objects)
+            return manifest
+        return self._update(manifest_key(self.eventer, hour), 'manifest',
+                            lambda: {'version': MANIFEST_VERSION, 'objects': {}}, merge)
+
+    def _register_layout(self):
+        """
+        Make sure the layout descriptor lists this writer's layout. False when it
+        couldn't be saved, a sharded writer writes nothing until it is.
+
+        Unsharded writers write anyway, readers take a missing descriptor as
+        unsharded, and retry every LAYOUT_RETRY_INTERVAL seconds. That keeps roles
+        without GetObject or ListBucket, and stores without conditional puts, working.
+        """
+        if self.layout_registered:
+            return True
+        if self.layout_retry is not None and time.monotonic() < self.layout_retry:
+            return True
+        def merge(layout):
+            if self.shards in layout['shards']:
+                return None
+            layout['shards'] = sorted(set(layout['shards']) | {self.shards})
+            return layout
+        self.layout_registered = self._update(layout_key(self.eventer), 'layout', self._first_layout, merge)
+        if self.layout_registered:
+            return True
+        metrics.incr('s3.layout_errors')
+        if self.shards:
+            return False
+        self.logger.warning('Couldn\'t register the unsharded layout in s3://%s/%s, writing anyway',
+                            self.bucket, layout_key(self.eventer))
+        self.layout_retry = time.monotonic() + LAYOUT_RETRY_INTERVAL
+        return True
+
+    def _first_layout(self):
+        # objects written before there was a descriptor are unsharded, years start with 2
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=f'{self.eventer}/2', MaxKeys=1)
+        existing = [0] if response.get('KeyCount', len(response.get('Contents', []))) else []
+        return {'version': LAYOUT_VERSION, 'shards': existing}
+
+    def _update(self, key, what, initial, merge):
+        """
+        Read-merge-write a json object with conditional puts. `merge` returns the
+        new document, or None when the stored one needs no change.
+        """
+        for _ in range(MANIFEST_RETRIES):
+            try:
+                try:
+                    response = self.client.get_object(Bucket=self.bucket, Key=key)
+                    document = json.loads(response['Body'].read())
+                    condition = {'IfMatch': response['ETag']}
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                        raise
+                    document = initial()
+                    condition = {'IfNoneMatch': '*'}
+                document = merge(document)
+                if document is None:
+                    return True
+                body = json.dumps(document).encode('utf-8')
+                self.client.put_object(Body=body, Bucket=self.bucket, Key=key, **condition)
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    metrics.incr(f's3.{what}_conflicts')
+                    continue # another writer updated it first, merge again
+                self.logger.error('Error saving %s to s3: %s ', what, e)
+                return False
+            except Exception as e:
+                self.logger.error('Error saving %s to s3: %s ', what, e)
+                return False
+        self.logger.error('Error saving %s to s3: too many conflicting writers for %s', what, key)
+        return False
 
     def buffer(self, file: File):
         """docstring"""
+        if self.segment:
+            line = self.codec.encode(file.content)
+            segment = self.segments.get(file.timestamp)
+            if segment is None:
+                segment = self.segments[file.timestamp] = Segment(file.timestamp, framed=self.codec.framed,
+                                                                  summary=self._summary())
+            segment.append(line, file.time)
+            if segment.summary:
+                segment.summary.add(file.content)
+            if segment.size >= self.max_bytes or len(segment.lines) >= self.max_count:
+                if self._put_segment(segment):
+                    del self.segments[file.timestamp]
+            return
         if file.timestamp not in self.packets:
             self.packets[file.timestamp] = [file]
         else:
             self.packets[file.timestamp].append(file)
     
     @classmethod
-    def from_sqs(cls, bucket):
-        return cls('sqs', bucket)
+    def from_sqs(cls, bucket, **kwargs):
+        return cls('sqs', bucket, **kwargs)
+
+    @classmethod
+    def from_kinesis(cls, bucket, **kwargs):
+        return cls('kinesis', bucket, **kwargs)
 
 
 class Reader():
     """
     Reader
+
+    The time range is planned into exact partitions, whole hours are listed with one
+    prefix and partial hours minute by minute. Partitions are listed in parallel, or
+    with `manifest=True` read from the hour manifests without any LIST calls.
+
+    Objects are fetched by `concurrency` threads, with at most `prefetch` objects
+    downloaded ahead of the caller. When `ordered` is set messages are yielded in
+    key (timestamp) order, otherwise in the order their objects finish downloading.
+
+    `start` and `end` may be given to the minute, second or millisecond, eg
+    2024/10/15/17/08/05.250, and `end` covers the whole of its last unit. Minutes
+    only partly inside the range are filtered with `timestamp`, a function returning
+    a stored message's epoch ms. Indexed segments in those minutes are read with
+    ranged GETs of just the blocks that overlap the range.
+
+    `where` is a storage.filters.Filter, only matching messages are yielded. With
+    `manifest=True` objects whose summaries rule out a match aren't fetched at all.
+
+    `after` skips every object up to and including that key, to resume a replay.
+
+    With `decode` set, each stored message is decoded once by it and yielded
+    decoded. `timestamp` and `where` then work on the decoded message.
+
+    Partitions are listed under every layout in the bucket's layout descriptor,
+    one LIST per hash shard in parallel, and merged in time order, see
+    `key_order`. Buckets without a descriptor are read as unsharded.
+
+    With `cache` set to a directory, fetched objects are kept there, up to
+    `cache_bytes`, and read back from disk on later reads of the same objects, see
+    storage.cache. Objects are matched by the ETag from the listing or manifest,
+    manifests written by older versions have none and are always fetched.
     """
-    def __init__(self, bucket, start, end):
-        self.client = boto3.client('s3')
-        self.resource = boto3.resource('s3')
+    def __init__(self, bucket, start, end, eventer='sqs', concurrency=READ_CONCURRENCY,
+                 prefetch=READ_PREFETCH, ordered=True, manifest=False, timestamp=None, where=None, after=None,
+                 cache=None, cache_bytes=read_cache.CACHE_MAX_BYTES, decode=None):
+        self.client = clients.client('s3')
         self.logger = logging.getLogger(__name__)
         self.bucket = bucket
-        self.start = self._string_to_datetime(start)
-        self.end = self._string_to_datetime(end)
-        self.prefix = self._common_prefix(start, end)
+        self.eventer = eventer
+        start, _ = self._parse(start)
+        end, precision = self._parse(end)
+        self.start_ms = self._to_ms(start)
+        self.end_ms = self._to_ms(end) + precision - 1
+        # partitions are planned by minute
+        self.start = start.replace(second=0, microsecond=0)
+        self.end = end.replace(second=0, microsecond=0)
+        self.after = after
+        if after:
+            # keys sort by time, nothing before the minute of `after` is needed
+            self.start = max(self.start, self._string_to_datetime(re.search(PATTERN, after).group(0)))
+        self.timestamp = timestamp
+        self.where = where
+        self.decode = decode
+        self.indexed = set() # segment keys with an index
+        self.etags = {} # key -> ETag, for the cache
+        self.layouts = None # shard counts in use, loaded on first listing
+        self.cache = read_cache.get(cache, cache_bytes) if cache else None
+        self.concurrency = concurrency
+        self.prefetch = max(prefetch, concurrency)
+        self.ordered = ordered
+        self.manifest = manifest
     
     def read(self):
         """
         Read messages
         """
+        for _, messages in self.objects():
+            yield from messages
+
+    def objects(self):
+        """
+        Read (key, messages) for each object
+        """
         files = self._files()
-        for key in files:
-            response = self.client.get_object(Bucket=key.bucket_name, Key=key.key) 
-            object_data = response['Body']
-            yield object_data.read()
+        if self.after:
+            after = key_order(self.after)
+            files = (key for key in files if key_order(key) > after)
+        fetch = lambda key: (key, self._fetch(key))
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        if self.ordered:
+            fetches = self._ordered(pool, fetch, files)
+        else:
+            fetches = self._unordered(pool, fetch, files)
+        try:
+            yield from fetches
+        finally:
+            # caller may stop early, don't wait on objects it will never read
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _fetch(self, key):
+        started = metrics.start()
+        messages = self._read(key)
+        metrics.observe('s3.fetch', started, len(messages))
+        return messages
+
+    def _read(self, key):
+        minute = self._to_ms(self._string_to_datetime(re.search(PATTERN, key).group(0)))
+        partial = minute < self.start_ms or minute + 59999 > self.end_ms
+        if partial and key in self.indexed:
+            messages = self._fetch_blocks(key)
+        else:
+            decode = lambda data: split_segment(key, data) if is_segment(key) else [bytes(data)]
+            messages = self._get(key, decode, self.etags.get(key))
+        if self.decode:
+            messages = [self.decode(m) for m in messages]
+        if partial and self.timestamp:
+            messages = [m for m in messages if self.start_ms <= self.timestamp(m) <= self.end_ms]
+        if self.where:
+            matches = self.where.matches if self.decode else self.where.matches_data
+            messages = [m for m in messages if matches(m)]
+        return messages
+
+    def _fetch_blocks(self, key):
+        """
+        Fetch only the blocks of an indexed segment that overlap the range
+        """
+        # an index only changes with its segment, so it's cached under the segment's ETag
+        etag = self.etags.get(key)
+        index = self._get(key + INDEX_EXTENSION, lambda data: json.loads(bytes(data)), etag)
+        blocks = [block for block in index['blocks'] if block[1] >= self.start_ms and block[0] <= self.end_ms]
+        if not blocks:
+            return []
+        byte_range = f'bytes={blocks[0][2]}-{blocks[-1][3] - 1}'
+        return self._get(key, lambda data: split_segment(key, data), etag, byte_range)
+
+    def _get(self, key, decode, etag, byte_range=None):
+        """
+        `decode` of an object's data, from the cache when it holds this version
+        """
+        if self.cache and etag:
+            with self.cache.open(self.bucket, key, etag, byte_range) as cached:
+                if cached is not None:
+                    return decode(cached)
+        params = dict(Bucket=self.bucket, Key=key)
+        if byte_range:
+            params['Range'] = byte_range
+        data = self.client.get_object(**params)['Body'].read()
+        if self.cache and etag:
+            self.cache.put(self.bucket, key, etag, data, byte_range)
+        return decode(data)
+
+    def _ordered(self, pool, fn, items):
+        window = deque()
+        for item in items:
+            window.append(pool.submit(fn, item))
+            if len(window) >= self.prefetch:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+    def _unordered(self, pool, fn, items):
+        pending = set()
+        for item in items:
+            pending.add(pool.submit(fn, item))
+            if len(pending) >= self.prefetch:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
 
     @staticmethod
     def _string_to_datetime(dt):
-        return datetime.strptime(dt, '%Y/%m/%d/%H/%M').replace(tzinfo=timezone.utc)
+        return Reader._parse(dt)[0]
+
+    @staticmethod
+    def _parse(dt):
+        return parse_time(dt)
+
+    @staticmethod
+    def _to_ms(dt):
+        return int(dt.timestamp()) * 1000 + dt.microsecond // 1000
 
     @staticmethod    
     def _strings_to_datetime(*dts):
         return [Reader._string_to_datetime(dt) for dt in dts]
-    
-    def _common_prefix(self, start, end):
-        prefix = ''
-        for char in zip(start, end):
-            if len(set(char)) == 1:
-                prefix += char[0]
+
+    @staticmethod
+    def _partitions(start, end):
+        """
+        Exact hour and minute partitions covering start to end, in time order
+        """
+        partitions = []
+        ts = start
+        while ts <= end:
+            if ts.minute == 0 and ts + timedelta(minutes=59) <= end:
+                partitions.append(ts.strftime('%Y/%m/%d/%H'))
+                ts += timedelta(hours=1)
             else:
-                break
-        prefix = prefix.rpartition('/')[0] + '/'
-        return prefix
+                partitions.append(ts.strftime('%Y/%m/%d/%H/%M'))
+                ts += timedelta(minutes=1)
+        return partitions
 
     def _files(self):
-        bucket = self.resource.Bucket(self.bucket)
-        candidates = bucket.objects.filter(Prefix=self.prefix)
-        for obj in candidates:
-            match = re.search(PATTERN, obj.key)
-            if match:
-                ts = self._string_to_datetime(match.group(0))
-                if self.start <= ts <= self.end:
-                    yield obj
+        partitions = self._partitions(self.start, self.end)
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            if self.manifest:
+                hours = {}
+                for partition in partitions:
+                    hours.setdefault(partition[:13], []).append(partition)
+                for keys in self._ordered(pool, self._manifest_files, hours.items()):
+                    yield from keys
+                return
+            # every shard of every partition is listed in parallel, then each partition is merged
+            items = [(partition, prefix) for partition in partitions for prefix in self._prefixes(partition)]
+            listed = self._ordered(pool, lambda item: (item[0], self._list_prefix(item[1])), items)
+            for _, group in itertools.groupby(listed, key=lambda item: item[0]):
+                yield from sorted((key for _, keys in group for key in keys), key=key_order)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _load_layouts(self):
+        if self.layouts is not None:
+            return self.layouts
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=layout_key(self.eventer))
+            layout = json.loads(response['Body'].read())
+            if layout.get('version') != LAYOUT_VERSION:
+                raise exceptions.EventerException(f'unsupported layout version: {layout.get("version")}')
+            self.layouts = layout['shards']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            self.layouts = [0]
+        return self.layouts
+
+    def _prefixes(self, partition):
+        """
+        Prefixes holding a partition's objects under every layout in use
+        """
+        prefixes = []
+        for shards in self._load_layouts():
+            if not shards:
+                prefixes.append(f'{self.eventer}/{partition}/')
             else:
-                raise exceptions.S3KeyException('regex failed - invalid s3 key')
-            
-        
\ No newline at end of file
+                prefixes.extend(f'{self.eventer}/{shard:02x}/{partition}/' for shard in range(shards))
+        return prefixes
+
+    def _list(self, partition):
+        keys = [key for prefix in self._prefixes(partition) for key in self._list_prefix(prefix)]
+        return sorted(keys, key=key_order)
+
+    def _list_prefix(self, prefix):
+        started = metrics.start()
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith(INDEX_EXTENSION):
+                    self.indexed.add(obj['Key'][:-len(INDEX_EXTENSION)])
+                elif re.search(PATTERN, obj['Key']):
+                    keys.append(obj['Key'])
+                    self.etags[obj['Key']] = obj.get('ETag')
+                else:
+                    self.logger.warning('skipping invalid s3 key: %s', obj['Key'])
+        metrics.observe('s3.list', started, len(keys))
+        return keys
+
+    def _manifest_files(self, item):
+        hour, partitions = item
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=manifest_key(self.eventer, hour))
+            manifest = json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            self.logger.info('no manifest for %s, listing instead', hour)
+            return [key for partition in partitions for key in self._list(partition)]
+        partitions = tuple(partitions)
+        keys, skipped = [], 0
+        for key, entry in manifest['objects'].items():
+            # matched by time rather than prefix, sharded keys start with their shard
+            minute = re.search(PATTERN, key)
+            if not minute or not minute.group(0).startswith(partitions):
+                continue
+            if self.where and not self.where.may_match(entry.get('summary')):
+                skipped += 1
+                continue
+            keys.append(key)
+            self.etags[key] = entry.get('etag')
+            if entry.get('index'):
+                self.indexed.add(key)
+        if skipped:
+            self.logger.info('skipped %d of %d objects in %s by summary', skipped, skipped + len(keys), hour)
+        return sorted(keys, key=key_order)
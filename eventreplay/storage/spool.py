@@ -0,0 +1,216 @@
+"""
+Local append-only spool so persistence never blocks consumption.
+"""
+import os
+import json
+import queue
+import logging
+import threading
+
+from eventreplay.storage import codec
+from eventreplay.storage.s3 import File
+
+
+QUEUE_SIZE = 100 # batches held in memory before spilling straight to disk
+UPLOAD_INTERVAL = 1.0 # seconds between uploads when idle
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+
+
+class Spool():
+    """
+    Newline-delimited files appended to a local file. The offset of the first entry
+    not yet saved to storage is kept next to it in `<path>.offset`.
+
+    `base` counts the bytes of the file before it was last truncated, so base plus
+    an offset only ever grows within a process.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = f'{path}.offset'
+        self.lock = threading.Lock()
+        self.committed = self._load_offset()
+        self._repair()
+        self.position = self.committed
+        self.base = 0
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_path, encoding='utf-8') as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _repair(self):
+        """
+        Drop a partially written last entry left by a crash
+        """
+        if not os.path.exists(self.path):
+            open(self.path, 'ab').close()
+            return
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+        self.committed = min(self.committed, end)
+
+    def append(self, files):
+        """
+        Append files, returns the end of what was appended, comparable with `saved`
+        """
+        lines = b''.join(
+            json.dumps(dict(name=file.name, timestamp=file.timestamp, content=codec.as_dict(file.content), time=file.time),
+                       separators=(',', ':')).encode('utf-8') + b'\n'
+            for file in files
+        )
+        with self.lock, open(self.path, 'ab') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+            return self.base + f.tell()
+
+    def saved(self):
+        """
+        End of what has been saved to storage, comparable with what `append` returns
+        """
+        with self.lock:
+            return self.base + self.committed
+
+    def read(self):
+        """
+        Entries appended since the last read, as (offset, File) pairs
+        """
+        with self.lock, open(self.path, 'rb') as f:
+            f.seek(self.position)
+            data = f.read()
+        entries = []
+        offset = self.position
+        for line in data.splitlines(keepends=True):
+            entry = json.loads(line)
+            entries.append((offset, File(entry['name'], entry['timestamp'], entry['content'], entry.get('time'))))
+            offset += len(line)
+        self.position = offset
+        return entries
+
+    def commit(self, offset):
+        """
+        Mark everything before offset as saved. Once the whole spool is saved the
+        file is truncated so it doesn't grow without bound.
+        """
+        with self.lock:
+            committed = self.committed
+            if offset == self.position == os.path.getsize(self.path):
+                with open(self.path, 'wb'):
+                    pass
+                self.base += offset
+                offset = self.position = 0
+            if offset == committed:
+                return
+            tmp = f'{self.offset_path}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(str(offset))
+            os.replace(tmp, self.offset_path)
+            self.committed = offset
+
+
+class Persister():
+    """
+    Background persistence stage.
+
+    `submit` hands files to a bounded in-memory queue, or appends them straight to the
+    spool when the queue is full, so it never waits on S3. A background thread moves
+    queued files to the spool and uploads the spool through the writer. The spool
+    offset only moves past files once the writer has saved them, so anything left on
+    restart is uploaded again. Entries may be uploaded twice after a crash.
+
+    `submit` returns a ticket, and `saved(ticket)` tells once those files are in
+    storage, for callers that must not acknowledge their source before then.
+    """
+    def __init__(self, writer, path, queue_size=QUEUE_SIZE, interval=UPLOAD_INTERVAL):
+        self.writer = writer
+        self.spool = Spool(path)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.interval = interval
+        self.logger = logging.getLogger(__name__)
+        self.held = {} # timestamp -> spool offset of its oldest file still buffered in the writer
+        self.lock = threading.Lock()
+        self.tickets = 0
+        self.unsaved = {} # ticket -> end of its files in the spool, None while queued
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='eventreplay-persist', daemon=True)
+        self.thread.start()
+
+    def submit(self, files):
+        with self.lock:
+            self.tickets += 1
+            ticket = self.tickets
+            self.unsaved[ticket] = None
+        try:
+            self.queue.put_nowait((ticket, files))
+        except queue.Full:
+            self.logger.debug('persist queue full, spilling to spool')
+            self._append([ticket], files)
+        return ticket
+
+    def saved(self, ticket):
+        """
+        True once the files submitted with `ticket` have been saved to storage
+        """
+        with self.lock:
+            return ticket not in self.unsaved
+
+    def _append(self, tickets, files):
+        end = self.spool.append(files)
+        with self.lock:
+            for ticket in tickets:
+                self.unsaved[ticket] = end
+
+    def close(self):
+        """
+        Stop the background thread, then save everything that is left
+        """
+        self._stop.set()
+        self.thread.join()
+        self._drain()
+        self._upload(force=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                ticket, files = self.queue.get(timeout=self.interval)
+                self._append([ticket], files)
+            except queue.Empty:
+                pass
+            try:
+                self._drain()
+                self._upload()
+            except Exception as e:
+                self.logger.error('Error persisting spool: %s', e)
+
+    def _drain(self):
+        tickets, files = [], []
+        while True:
+            try:
+                ticket, queued = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            tickets.append(ticket)
+            files.extend(queued)
+        if tickets:
+            self._append(tickets, files)
+
+    def _upload(self, force=False):
+        entries = self.spool.read()
+        for offset, file in entries:
+            self.held.setdefault(file.timestamp, offset)
+            self.writer.buffer(file)
+        self.writer.write()
+        if force:
+            self.writer.flush()
+        pending = self.writer.pending()
+        self.held = {ts: offset for ts, offset in self.held.items() if ts in pending}
+        self.spool.commit(min(self.held.values(), default=self.spool.position))
+        saved = self.spool.saved()
+        with self.lock:
+            self.unsaved = {ticket: end for ticket, end in self.unsaved.items() if end is None or end > saved}
@@ -0,0 +1,33 @@
+"""
+Example implementation - Export stored messages to a local columnar file
+
+Needs the optional export dependencies: pip install -r requirements-export.txt
+
+    python3 exporter.py --action sqs --start 2024/10/15/00/00 --end 2024/10/15/23/59 --output day.parquet --field body.type
+"""
+import os
+import logging
+import argparse
+
+from eventreplay import export
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description='exporter')
+parser.add_argument('--action', choices=['sqs', 'kinesis'], default='sqs', help='eventer the messages were stored by')
+parser.add_argument('--start', required=True, help='yyyy/mm/dd/hh/mm[/ss[.fff]], UTC')
+parser.add_argument('--end', required=True, help='yyyy/mm/dd/hh/mm[/ss[.fff]], UTC, inclusive')
+parser.add_argument('--output', required=True, help='local file to write')
+parser.add_argument('--format', choices=export.FORMATS, default='parquet')
+parser.add_argument('--field', action='append', dest='fields', default=[], help='dotted path exported as an extra column, repeatable')
+parser.add_argument('--concurrency', type=int, default=32, help='objects fetched at once')
+
+S3_BUCKET = 'event-replay-3jxh'
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    rows = export.export(args.start, args.end, S3_BUCKET, args.output, eventer=args.action, format=args.format,
+                         fields=args.fields, storage_options=dict(concurrency=args.concurrency))
+    logger.info('Export finished: %d rows', rows)
@@ -1,5 +1,7 @@
 """
 Example implementation - Replay messages to designated eventing service
+
+    python3 replayer.py --action sqs --start 2024/10/15/17/00 --end 2024/10/15/19/30 --workers 4
 """
 import os
 import logging
@@ -7,15 +9,17 @@ import argparse
 
 from eventreplay import eventers
 from eventreplay import exceptions
+from eventreplay import parallel
 
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(description='replayer')
 parser.add_argument('--action', action="store", dest='action', default=0)
-args = parser.parse_args()
+parser.add_argument('--start', required=True, help='yyyy/mm/dd/hh/mm[/ss[.fff]], UTC')
+parser.add_argument('--end', required=True, help='yyyy/mm/dd/hh/mm[/ss[.fff]], UTC, inclusive')
+parser.add_argument('--workers', type=int, default=1, help='replay processes, the range is split between them')
 
-ACTION = args.action
 S3_BUCKET = 'event-replay-3jxh'
 QUEUE_NAME = 'eventreplay'
 
@@ -23,37 +27,38 @@ def main(**kwargs):
     """
     SQS eventer
     """
-    start = kwargs.get('start')
-    end = kwargs.get('end')
+    start = kwargs.pop('start')
+    end = kwargs.pop('end')
+    workers = kwargs.pop('workers')
     eventer = kwargs.get('eventer')
     logger.info('Starting eventer %s\n', eventer)
 
-    client = eventers.client(eventer, **kwargs)
-    client.replay(start, end, S3_BUCKET)
+    if workers > 1:
+        kwargs.pop('action')
+        summary = parallel.replay(kwargs.pop('eventer'), start, end, S3_BUCKET, workers=workers, **kwargs)
+    else:
+        client = eventers.client(eventer, **kwargs)
+        summary = client.replay(start, end, S3_BUCKET)
+    logger.info('Replay finished: %s', summary)
     
 
 if __name__ == "__main__":
-    args = None
-    start = "2024/10/15/17/00" # yyyy/mm/dd/hh/mm - must be UTC for now
-    end = "2024/10/15/19/30"
-    match ACTION:
+    # parsed here, worker processes import this module too
+    args = parser.parse_args()
+    match args.action:
         case 'sqs':
-            args = dict(
+            params = dict(
                 action = 'replay',
                 eventer = 'sqs',
-                start = start,
-                end = end,
                 queue = "fake-service",
             )
         case 'kinesis':
-            args = dict(
+            params = dict(
                 action = 'replay',
                 eventer = 'kinesis',
-                start = start,
-                end = end,
                 stream_name = 'test-1',
             )
         case _:
             raise exceptions.EventerException('action not implemented')
 
-    main(**args)
+    main(start=args.start, end=args.end, workers=args.workers, **params)
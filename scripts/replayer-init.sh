@@ -1,4 +1,5 @@
 #!/bin/bash
+# ./scripts/replayer-init.sh sqs --start 2024/10/15/17/00 --end 2024/10/15/19/30 [--workers 4]
 ACTION=$1
 
-python3 replayer.py --action $ACTION
\ No newline at end of file
+python3 replayer.py --action $ACTION "${@:2}"
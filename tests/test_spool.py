@@ -0,0 +1,22 @@
+from eventreplay.storage.s3 import File
+from eventreplay.storage.spool import Spool
+
+
+def _names(spool):
+    return [file.name for _, file in spool.read()]
+
+
+def test_restart_after_truncating_commit(tmp_path):
+    path = str(tmp_path / 'spool')
+    spool = Spool(path)
+    spool.append([File('a', 0, {})])
+    spool.append([File('b', 0, {})])
+    entries = spool.read()
+    spool.commit(entries[1][0])
+    spool.commit(spool.position)
+    with open(f'{path}.offset', encoding='utf-8') as f:
+        assert f.read() == '0'
+
+    spool.append([File('c', 0, {})])
+    spool.append([File('d', 0, {})])
+    assert _names(Spool(path)) == ['c', 'd']
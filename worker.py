@@ -7,16 +7,20 @@ import argparse
 
 from eventreplay import eventers
 from eventreplay import exceptions
+from eventreplay import metrics
 
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(description='worker')
 parser.add_argument('--action', action="store", dest='action', default=0)
+parser.add_argument('--start', help='with --action sqs-backfill, yyyy/mm/dd/hh/mm, UTC')
+parser.add_argument('--end', help='with --action sqs-backfill, yyyy/mm/dd/hh/mm, UTC, inclusive')
 args = parser.parse_args()
 
 ACTION = args.action
 S3_BUCKET = 'event-replay-3jxh'
+METRICS_PORT = os.environ.get('METRICS_PORT') # serve prometheus metrics at :port/metrics
 
 def main(**kwargs):
     """
@@ -24,6 +28,10 @@ def main(**kwargs):
     """
     eventer = kwargs.get('eventer')
     logger.info('Starting %s consumer', eventer)
+    if METRICS_PORT:
+        registry = metrics.Registry()
+        metrics.set_sink(registry)
+        metrics.serve(registry, int(METRICS_PORT), host='0.0.0.0')
     # initialize clients outside of handler, handler just picks one
     client = eventers.client(eventer, **kwargs)
     for _ in client.consume():
@@ -31,6 +39,7 @@ def main(**kwargs):
 
 # ./scripts/worker-init.sh sqs
 # ./scripts/worker-init.sh kinesis
+# python3 worker.py --action sqs-backfill --start 2024/10/15/17/00 --end 2024/10/15/19/30
 if __name__ == "__main__":
     args = None
     match ACTION:
@@ -43,11 +52,23 @@ if __name__ == "__main__":
                 message_store='s3',
                 storage_destination=S3_BUCKET,
             )
+        case 'sqs-backfill':
+            # same handler, fed straight from storage instead of the queue
+            args = dict(
+                action = 'source',
+                eventer = 'sqs',
+                bucket = S3_BUCKET,
+                start = args.start,
+                end = args.end,
+            )
         case 'kinesis':
             args = dict(
                 action = 'consume',
                 eventer = 'kinesis',
                 stream_name = 'test-1',
+                persist_messages=True,
+                message_store='s3',
+                storage_destination=S3_BUCKET,
             )
         case _:
             raise exceptions.EventerException('action not implemented')